@@ -1,10 +1,39 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import contextlib
+import glob
+import hashlib
+import json
+import math
 import os
+import re
 import shutil
+import signal
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Literal
 
 from fastmcp import Context, FastMCP
+from fastmcp.server.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 mcp = FastMCP(name="Siril SeeStar Mosaic Processor")
 
@@ -153,6 +182,255 @@ SSF_SCRIPTS = {
     "narrowband": "Naztronomy-Seestar_Narrowband_Mosaic.ssf",  # LP filter
 }
 
+# Siril output is streamed to a rotating log on disk; only a small tail of
+# each job's output is kept in memory, however chatty Siril gets.
+JOB_LOG_MAX_BYTES = 5 * 1024 * 1024
+JOB_LOG_BACKUP_COUNT = 3
+JOB_LOG_TAIL_LINES = 200
+# Number of trailing log lines included in the error raised for a failed job
+JOB_LOG_ERROR_LINES = 40
+# Logs of the most recent jobs kept on disk; older ones are deleted whenever
+# a new job log is created
+JOB_LOG_RETENTION = 50
+
+_JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Histogram buckets in seconds, from quick tool calls up to long Siril runs
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+
+def _format_metric_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Metric:
+    """Base class of the Prometheus-style metrics in MetricsRegistry."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(
+                f"{self.name} expects labels {self.label_names}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _format_labels(self, key: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{self._format_labels(key)} {_format_metric_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ] + self._samples()
+
+
+class Counter(_Metric):
+    """A value that only goes up, such as a number of calls or bytes."""
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A current value, read from function at scrape time if one is given."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {_format_metric_value(self.function())}"]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    """Counts observations, such as durations, into cumulative buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the duration of a with block, or of each call when used
+        as a decorator."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return counts[-1]
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(c), t) for key, (c, t) in self._values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = (("le", _format_metric_value(bound)),)
+                samples.append(
+                    f"{self.name}_bucket{self._format_labels(key, le)} {count}"
+                )
+            labels = self._format_labels(key)
+            samples.append(f"{self.name}_sum{labels} {_format_metric_value(total)}")
+            samples.append(f"{self.name}_count{labels} {counts[-1]}")
+        return samples
+
+
+class MetricsRegistry:
+    """Metrics of this server process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+_TOOL_CALLS = METRICS.register(
+    Counter(
+        "siril_mcp_tool_calls_total",
+        "MCP tool calls by tool and outcome.",
+        ("tool", "status"),
+    )
+)
+_TOOL_DURATION = METRICS.register(
+    Histogram("siril_mcp_tool_duration_seconds", "MCP tool call latency.", ("tool",))
+)
+_STAGE_DURATION = METRICS.register(
+    Histogram(
+        "siril_mcp_stage_duration_seconds",
+        "Duration of processing stages (queue, siril, analyze, preview, ssf_fetch, "
+        "ingest).",
+        ("stage",),
+    )
+)
+_JOBS_FINISHED = METRICS.register(
+    Counter("siril_mcp_jobs_total", "Finished Siril jobs by status.", ("status",))
+)
+_CACHE_REQUESTS = METRICS.register(
+    Counter(
+        "siril_mcp_cache_requests_total",
+        "Cache lookups by cache and result (hit, miss or error).",
+        ("cache", "result"),
+    )
+)
+_BYTES_PROCESSED = METRICS.register(
+    Counter(
+        "siril_mcp_bytes_processed_total",
+        "Bytes of input data processed, by operation.",
+        ("operation",),
+    )
+)
+METRICS.register(
+    Gauge(
+        "siril_mcp_job_queue_depth",
+        "Siril jobs waiting for a slot.",
+        function=lambda: _job_manager.queue_depth,
+    )
+)
+METRICS.register(
+    Gauge(
+        "siril_mcp_active_siril_processes",
+        "Siril processes currently running.",
+        function=lambda: _job_manager.active_processes,
+    )
+)
+
+
+class _ToolMetricsMiddleware(Middleware):
+    """
+    Records the latency and outcome of every tool call. Names that aren't
+    registered tools are recorded as "unknown", since clients choose them.
+    """
+
+    async def on_call_tool(self, context, call_next):
+        tool = context.message.name
+        if await mcp.get_tool(tool) is None:
+            tool = "unknown"
+        status = "error"
+        start = time.perf_counter()
+        try:
+            result = await call_next(context)
+            if not getattr(result, "is_error", False):
+                status = "ok"
+            return result
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            _TOOL_CALLS.inc(tool=tool, status=status)
+            _TOOL_DURATION.observe(time.perf_counter() - start, tool=tool)
+
+
+mcp.add_middleware(_ToolMetricsMiddleware())
+
 
 def _find_siril_binary() -> str:
     """
@@ -305,55 +583,712 @@ async def validate_siril_binary(binary_path: str, ctx: Context) -> str:
         return f"❌ Error testing binary: {str(e)}"
 
 
-def _process_seestar_mosaic(
-    project_dir: str,
-    filter_type: str = "broadband",
-) -> str:
+def _cache_dir() -> str:
     """
-    Internal function to process Seestar mosaic.
-    Separated for easier testing.
+    Returns the directory siril-mcp uses for logs and cached files, checking:
+    1. SIRIL_MCP_CACHE_DIR environment variable (if set)
+    2. $XDG_CACHE_HOME/siril-mcp
+    3. ~/.cache/siril-mcp
     """
-    # Validate inputs
-    ssf_name = SSF_SCRIPTS.get(filter_type)
-    if ssf_name is None:
-        raise ValueError(f"Unknown filter_type '{filter_type}'")
-    lights_dir = os.path.join(project_dir, "lights")
-    if not os.path.isdir(lights_dir):
-        raise FileNotFoundError(f"No 'lights' folder found at {lights_dir}")
+    custom_dir = os.environ.get("SIRIL_MCP_CACHE_DIR")
+    if custom_dir:
+        return custom_dir
+    base_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base_dir, "siril-mcp")
+
+
+def _job_log_dir() -> str:
+    """Returns the directory holding the per-job Siril logs."""
+    return os.path.join(_cache_dir(), "logs")
+
+
+def _new_job_id() -> str:
+    """Returns a new, time-sortable job identifier."""
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def _job_log_path(job_id: str, log_dir: str | None = None) -> str:
+    """Returns the path of the current log file for a job."""
+    if not _JOB_ID_PATTERN.match(job_id):
+        raise ValueError(f"Invalid job_id '{job_id}'")
+    return os.path.join(log_dir or _job_log_dir(), f"{job_id}.log")
+
+
+def _prune_job_logs(log_dir: str, keep: int) -> None:
+    """Deletes all but the ``keep`` most recent job logs, with their rotations."""
+    logs = []
+    for path in glob.glob(os.path.join(glob.escape(log_dir), "*.log")):
+        try:
+            logs.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            pass
+    logs.sort(reverse=True)
+    for _, path in logs[keep:]:
+        for stale in [path] + glob.glob(glob.escape(path) + ".*"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+class JobLog:
+    """
+    Rotating on-disk log for a single Siril job.
+
+    Lines are appended to ``<job_id>.log``; once that file would exceed
+    ``max_bytes`` it is rotated to ``<job_id>.log.1`` (and older files shifted
+    up to ``backup_count``). Only the last ``tail_lines`` lines are held in
+    memory, so memory per job stays constant, and only the logs of the last
+    ``retention`` jobs are kept on disk.
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        log_dir: str | None = None,
+        max_bytes: int = JOB_LOG_MAX_BYTES,
+        backup_count: int = JOB_LOG_BACKUP_COUNT,
+        tail_lines: int = JOB_LOG_TAIL_LINES,
+        retention: int = JOB_LOG_RETENTION,
+    ):
+        self.job_id = job_id
+        self.path = _job_log_path(job_id, log_dir)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._tail = deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        _prune_job_logs(os.path.dirname(self.path), max(retention - 1, 0))
+        # Line buffered so tail/search tools see output while the job runs
+        self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+        self._size = self._file.tell()
+
+    def write(self, line: str) -> None:
+        """Appends one line of output to the log."""
+        line = line.rstrip("\r\n")
+        data = line + "\n"
+        size = len(data.encode("utf-8"))
+        with self._lock:
+            self._tail.append(line)
+            if self._file is None:
+                return
+            if self._size and self._size + size > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._size += size
+
+    def _rotate(self) -> None:
+        self._file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                older = f"{self.path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8", buffering=1)
+        self._size = 0
+
+    def tail(self, lines: int | None = None) -> list[str]:
+        """Returns the last lines held in memory (all of them by default)."""
+        with self._lock:
+            kept = list(self._tail)
+        if lines is None:
+            return kept
+        return kept[-lines:] if lines > 0 else []
+
+    def close(self) -> None:
+        """Closes the log file; the in-memory tail stays available."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _job_log_files(job_id: str, log_dir: str | None = None) -> list[str]:
+    """
+    Returns the on-disk log files of a job, oldest first.
+    Raises FileNotFoundError if the job has no log.
+    """
+    path = _job_log_path(job_id, log_dir)
+    rotated = []
+    for rotated_path in glob.glob(glob.escape(path) + ".*"):
+        suffix = rotated_path[len(path) + 1 :]
+        if suffix.isdigit():
+            rotated.append((int(suffix), rotated_path))
+    files = [p for _, p in sorted(rotated, reverse=True)]
+    if os.path.isfile(path):
+        files.append(path)
+    if not files:
+        raise FileNotFoundError(f"No log found for job '{job_id}'")
+    return files
+
+
+def _read_last_lines(path: str, count: int, block_size: int = 64 * 1024) -> list[str]:
+    """Reads the last ``count`` lines of a file by seeking back from its end."""
+    if count <= 0:
+        return []
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b""
+        while end > 0 and data.count(b"\n") <= count:
+            start = max(0, end - block_size)
+            f.seek(start)
+            data = f.read(end - start) + data
+            end = start
+    return data.decode("utf-8", errors="replace").splitlines()[-count:]
+
+
+def _tail_job_log(
+    job_id: str, lines: int = 50, log_dir: str | None = None
+) -> list[str]:
+    """
+    Internal function returning the last lines of a job's log.
+    Only the requested lines are read, not the whole log.
+    """
+    tail: list[str] = []
+    for path in reversed(_job_log_files(job_id, log_dir)):
+        if len(tail) >= lines:
+            break
+        tail = _read_last_lines(path, lines - len(tail)) + tail
+    return tail
+
+
+def _search_job_log(
+    job_id: str,
+    pattern: str,
+    max_matches: int = 50,
+    ignore_case: bool = True,
+    log_dir: str | None = None,
+) -> list[tuple[int, str]]:
+    """
+    Internal function to grep a job's log.
+
+    Returns the last ``max_matches`` matching ``(line_number, line)`` pairs,
+    numbered across the rotated files that are still on disk. The log is
+    streamed line by line, so memory use is bounded by ``max_matches``.
+    """
+    try:
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise ValueError(f"Invalid search pattern '{pattern}': {e}") from e
+
+    matches: deque[tuple[int, str]] = deque(maxlen=max(max_matches, 0))
+    line_number = 0
+    for path in _job_log_files(job_id, log_dir):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line_number += 1
+                if regex.search(line):
+                    matches.append((line_number, line.rstrip("\n")))
+    return list(matches)
+
+
+class SirilJob:
+    """
+    A single Siril processing run.
+
+    Tracks the job's status and its Siril process so the job can be cancelled
+    (by a client or on timeout) from any thread.
+    """
+
+    def __init__(self, project_dir: str, filter_type: str, job_id: str | None = None):
+        self.job_id = job_id or _new_job_id()
+        self.project_dir = project_dir
+        self.filter_type = filter_type
+        self.status = "queued"
+        self.cancel_reason: str | None = None
+        # Set once Siril is actually signalled; a cancel that lands after
+        # Siril has exited doesn't turn its result into a cancellation
+        self.signalled = False
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self._proc: subprocess.Popen | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status not in ("queued", "running")
+
+    def attach(self, proc: subprocess.Popen) -> None:
+        """Records the job's Siril process; stops it at once if already cancelled."""
+        with self._lock:
+            self._proc = proc
+            self.status = "running"
+            self.started_at = time.time()
+            cancelled = self.cancel_reason is not None
+            self.signalled = cancelled
+        if cancelled:
+            _terminate_process_tree(proc)
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """
+        Requests cancellation of the job, stopping its whole Siril process tree
+        in the background. Returns False if the job has already finished.
+        """
+        with self._lock:
+            if self.finished:
+                return False
+            if self.cancel_reason is None:
+                self.cancel_reason = reason
+            proc = self._proc
+            if proc is not None and proc.poll() is None:
+                self.signalled = True
+            else:
+                proc = None
+        if proc is not None:
+            threading.Thread(
+                target=_terminate_process_tree, args=(proc,), daemon=True
+            ).start()
+        return True
+
+    def finish(self, status: str) -> None:
+        with self._lock:
+            self.status = status
+            self.finished_at = time.time()
+            self._proc = None
+        _JOBS_FINISHED.inc(status=status)
+
+
+# Finished jobs beyond this are forgotten by the job manager; their logs stay
+# on disk.
+MAX_FINISHED_JOBS = 100
+# How often a queued job checks whether it has been cancelled
+JOB_QUEUE_POLL_SECONDS = 0.5
+
+
+class JobManager:
+    """
+    Siril jobs shared by every client session of this server process.
+
+    At most max_concurrent_jobs run at once, and only one at a time per
+    project directory; other jobs wait in a first-come, first-served queue.
+    Defaults to $SIRIL_MCP_MAX_JOBS, or 1 since a single Siril run already
+    uses every core.
+    """
+
+    def __init__(self, max_concurrent_jobs: int | None = None):
+        if max_concurrent_jobs is None:
+            max_concurrent_jobs = int(os.environ.get("SIRIL_MCP_MAX_JOBS", "1"))
+        self.max_concurrent_jobs = max(max_concurrent_jobs, 1)
+        self._jobs: dict[str, SirilJob] = {}
+        self._queue: deque[SirilJob] = deque()
+        self._running: set[str] = set()
+        self._busy_projects: set[str] = set()
+        self._condition = threading.Condition()
+        # Event loops with a job waiting in acquire(), woken on changes
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a slot."""
+        with self._condition:
+            return len(self._queue)
+
+    @property
+    def running_count(self) -> int:
+        """Number of jobs holding a slot."""
+        with self._condition:
+            return len(self._running)
+
+    @property
+    def active_processes(self) -> int:
+        """Number of jobs whose Siril process is running."""
+        with self._condition:
+            return sum(1 for job in self._jobs.values() if job.status == "running")
+
+    def set_max_concurrent_jobs(self, max_concurrent_jobs: int) -> None:
+        with self._condition:
+            self.max_concurrent_jobs = max(max_concurrent_jobs, 1)
+            self._notify()
+
+    def register(self, job: SirilJob) -> SirilJob:
+        """Adds a job, pruning the oldest finished jobs."""
+        with self._condition:
+            self._jobs[job.job_id] = job
+            finished = [j for j in self._jobs.values() if j.finished]
+            for old_job in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self._jobs[old_job.job_id]
+        return job
+
+    def get(self, job_id: str) -> SirilJob:
+        with self._condition:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Unknown job '{job_id}'")
+        return job
+
+    def jobs(self) -> list[SirilJob]:
+        """Returns all known jobs, oldest first."""
+        with self._condition:
+            return list(self._jobs.values())
+
+    def _notify(self) -> None:
+        """Wakes every waiting job; called with the condition held."""
+        self._condition.notify_all()
+        for loop, event in self._waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def _take_slot(self, job: SirilJob) -> None:
+        self._running.add(job.job_id)
+        self._busy_projects.add(os.path.realpath(job.project_dir))
+
+    def _can_start(self, job: SirilJob) -> bool:
+        if len(self._running) >= self.max_concurrent_jobs:
+            return False
+        for queued in self._queue:
+            if os.path.realpath(queued.project_dir) in self._busy_projects:
+                continue
+            # The first queued job whose project is free goes next
+            return queued is job
+        return False
+
+    async def acquire(self, job: SirilJob) -> bool:
+        """
+        Waits until the job may run. Returns False, without taking a slot, if
+        the job is cancelled while it waits. The wait happens on the event
+        loop, so a queued job doesn't tie up a worker thread that other tools
+        need.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._condition:
+            self._queue.append(job)
+            self._waiters.add(waiter)
+        try:
+            while True:
+                with self._condition:
+                    waiter[1].clear()
+                    if job.cancel_reason is not None:
+                        return False
+                    if self._can_start(job):
+                        self._take_slot(job)
+                        return True
+                # Cancellation doesn't notify, so wake up to check for it
+                poll = loop.call_later(JOB_QUEUE_POLL_SECONDS, waiter[1].set)
+                try:
+                    await waiter[1].wait()
+                finally:
+                    poll.cancel()
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+                self._queue.remove(job)
+                self._notify()
+
+    def release(self, job: SirilJob) -> None:
+        """Frees the slot taken by acquire()."""
+        with self._condition:
+            self._running.discard(job.job_id)
+            self._busy_projects.discard(os.path.realpath(job.project_dir))
+            self._notify()
+
+
+_job_manager = JobManager()
+
+
+# Seconds Siril gets to exit after SIGTERM before its process group is killed
+SIRIL_TERMINATE_GRACE_SECONDS = 10.0
+
+
+def _process_group_kwargs() -> dict:
+    """Popen arguments that start Siril in its own process group."""
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def _signal_process_group(pid: int, sig: int) -> None:
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        # The whole group has already exited
+        pass
+
+
+def _terminate_process_tree(
+    proc: subprocess.Popen, grace_period: float | None = None
+) -> None:
+    """
+    Stops a process started with _process_group_kwargs() and everything it
+    spawned: asks the group to terminate, then kills it after grace_period.
+    """
+    if grace_period is None:
+        grace_period = SIRIL_TERMINATE_GRACE_SECONDS
+
+    if os.name == "nt":
+        if proc.poll() is None:
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+            try:
+                proc.wait(timeout=grace_period)
+            except subprocess.TimeoutExpired:
+                subprocess.run(
+                    ["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+                    capture_output=True,
+                )
+        return
+
+    _signal_process_group(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        pass
+    # Also reaps children that outlived the Siril process itself
+    _signal_process_group(proc.pid, signal.SIGKILL)
+
+
+def _run_siril_script(
+    siril_binary: str,
+    ssf_name: str,
+    job_log: JobLog,
+    cwd: str,
+    job: SirilJob,
+    timeout: float | None = None,
+) -> int:
+    """
+    Runs a Siril script in its own process group, streaming its combined
+    stdout/stderr into job_log. The job is cancelled with reason "timeout"
+    if Siril runs longer than timeout seconds. Returns Siril's exit code.
+    """
+    proc = subprocess.Popen(
+        [siril_binary, "-s", ssf_name],
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        **_process_group_kwargs(),
+    )
+    job.attach(proc)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, job.cancel, args=("timeout",))
+        timer.daemon = True
+        timer.start()
+    try:
+        with proc.stdout:
+            for line in proc.stdout:
+                job_log.write(line)
+        return proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+def _snapshot_project_outputs(project_dir: str) -> set[str]:
+    """
+    Returns the Siril outputs currently in a project: the process/ dir and its
+    entries, and the ``*_og``/``*_SPCC`` mosaics in the project root. Outputs
+    of other tools (such as ``*_tiles`` pyramids) are left out.
+    """
+    entries = set(_find_mosaic_outputs(project_dir))
+    process_dir = os.path.join(project_dir, "process")
+    if os.path.isdir(process_dir):
+        entries.add(process_dir)
+        entries.update(
+            os.path.join(process_dir, name) for name in os.listdir(process_dir)
+        )
+    return entries
+
+
+def _remove_new_outputs(project_dir: str, before: set[str]) -> None:
+    """Removes the Siril outputs a run created since the snapshot was taken."""
+    for path in sorted(_snapshot_project_outputs(project_dir) - before, reverse=True):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
 
-    # Change into the project dir so Siril picks up the .ssf script automatically
-    cwd = os.getcwd()
+def _parse_job_timeout(value: float | str | None) -> float | None:
+    """
+    Parses a job timeout in seconds; None, an empty string or a value <= 0
+    means no limit. Raises ValueError if the value is not a number.
+    """
+    if value is None or value == "":
+        return None
     try:
-        os.chdir(project_dir)
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid job timeout {value!r}: expected seconds") from None
+    if math.isnan(timeout):
+        raise ValueError(f"Invalid job timeout {value!r}: expected seconds")
+    return timeout if timeout > 0 else None
+
+
+# Parsed once at startup so a bad value fails fast rather than inside a job
+_default_job_timeout = _parse_job_timeout(os.environ.get("SIRIL_MCP_JOB_TIMEOUT"))
+
+
+def _job_timeout(timeout: float | None) -> float | None:
+    """Returns the timeout to use, falling back to SIRIL_MCP_JOB_TIMEOUT."""
+    if timeout is not None:
+        return _parse_job_timeout(timeout)
+    return _default_job_timeout
+
 
+def _run_mosaic_job(job: SirilJob, ssf_name: str, timeout: float | None) -> None:
+    """
+    Runs a queued job's Siril script once it holds a slot, and raises if it
+    fails, times out or is cancelled.
+    """
+    project_dir = job.project_dir
+    try:
         # Create the SSF script file if it doesn't exist
         ssf_path = os.path.join(project_dir, ssf_name)
         if not os.path.isfile(ssf_path):
             with open(ssf_path, "w", encoding="utf-8") as f:
-                f.write(SSF_SCRIPT_CONTENTS[filter_type])
+                f.write(SSF_SCRIPT_CONTENTS[job.filter_type])
 
-        # Invoke Siril in batch/script mode
+        # Invoke Siril in batch/script mode from the project dir so it picks
+        # up the .ssf script
         siril_binary = _find_siril_binary()
-        cmd = [siril_binary, "-s", ssf_name]
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        if proc.returncode != 0:
-            raise RuntimeError(f"Siril failed:\n{proc.stderr}")
-
-        # By convention the script writes its mosaic into a 'process/' subdir
-        # with a predictable name—adjust if the script differs.
-        output_path = os.path.join(project_dir, "process", "mosaic.fits")
-        if not os.path.isfile(output_path):
-            # Note: Can't log here since this is not an async function
-            pass
-        return output_path
+        before = _snapshot_project_outputs(project_dir)
+        job_log = JobLog(job.job_id)
+        try:
+            with _STAGE_DURATION.time(stage="siril"):
+                returncode = _run_siril_script(
+                    siril_binary, ssf_name, job_log, project_dir, job, timeout
+                )
+        finally:
+            job_log.close()
+    except BaseException:
+        job.finish("failed")
+        raise
+
+    # Siril exiting 0 means it finished its work before the signal landed
+    if job.signalled and returncode != 0:
+        _remove_new_outputs(project_dir, before)
+        if job.cancel_reason == "timeout":
+            job.finish("timed_out")
+            raise TimeoutError(
+                f"Siril job {job.job_id} timed out after {timeout:g}s and was "
+                f"stopped; partial intermediates were removed. "
+                f"Full log: {job_log.path}"
+            )
+        job.finish("cancelled")
+        raise RuntimeError(
+            f"Siril job {job.job_id} was cancelled; partial intermediates were "
+            f"removed. Full log: {job_log.path}"
+        )
+
+    if returncode != 0:
+        job.finish("failed")
+        tail = "\n".join(job_log.tail(JOB_LOG_ERROR_LINES))
+        raise RuntimeError(
+            f"Siril failed with exit code {returncode} (job {job.job_id}). "
+            f"Last lines of output:\n{tail}\n"
+            f"Full log: {job_log.path}"
+        )
+    job.finish("succeeded")
+
+
+def _register_mosaic_job(
+    project_dir: str, filter_type: str, job: SirilJob | None, timeout: float | None
+) -> tuple[SirilJob, str, float | None]:
+    """
+    Validates a mosaic request and registers its job with the job manager.
+    Returns the job, its SSF script name and the timeout to use.
+    """
+    ssf_name = SSF_SCRIPTS.get(filter_type)
+    if ssf_name is None:
+        raise ValueError(f"Unknown filter_type '{filter_type}'")
+    lights_dir = os.path.join(project_dir, "lights")
+    if not os.path.isdir(lights_dir):
+        raise FileNotFoundError(f"No 'lights' folder found at {lights_dir}")
+    timeout = _job_timeout(timeout)
+    job = _job_manager.register(job or SirilJob(project_dir, filter_type))
+    return job, ssf_name, timeout
+
+
+def _run_queued_mosaic_job(job: SirilJob, ssf_name: str, timeout: float | None) -> str:
+    """
+    Runs a job that holds a slot, freeing the slot afterwards. Returns the
+    path of the mosaic.
+
+    Siril's output is written to the job's log instead of being held in
+    memory. If the job is cancelled or runs longer than timeout seconds,
+    Siril's whole process tree is stopped and the outputs the run created
+    (in process/, and the ``*_og``/``*_SPCC`` mosaics) are removed.
+    """
+    try:
+        _run_mosaic_job(job, ssf_name, timeout)
     finally:
-        os.chdir(cwd)
+        _job_manager.release(job)
+
+    # By convention the script writes its mosaic into a 'process/' subdir
+    # with a predictable name—adjust if the script differs.
+    output_path = os.path.join(job.project_dir, "process", "mosaic.fits")
+    if not os.path.isfile(output_path):
+        # Note: Can't log here since this is not an async function
+        pass
+    return output_path
+
+
+async def _run_job_in_thread(
+    job: SirilJob, ssf_name: str, timeout: float | None
+) -> str:
+    """
+    Runs a job that holds a slot in a worker thread. If the caller is
+    cancelled before a thread picks the work up, the thread never runs, so
+    the slot is freed and the job finished here instead.
+    """
+    claim = threading.Lock()
+    state = {"started": False, "abandoned": False}
+
+    def run() -> str | None:
+        with claim:
+            if state["abandoned"]:
+                return None
+            state["started"] = True
+        return _run_queued_mosaic_job(job, ssf_name, timeout)
+
+    try:
+        return await asyncio.to_thread(run)
+    except asyncio.CancelledError:
+        with claim:
+            state["abandoned"] = not state["started"]
+        if state["abandoned"]:
+            _job_manager.release(job)
+            job.finish("cancelled")
+        raise
+
+
+async def _preview_job_output(job: SirilJob, ctx: Context = None) -> None:
+    """
+    Post-processing stage: generates the preview pyramid for the newest mosaic
+    saved by a finished job. A failure here doesn't fail the job.
+    """
+    try:
+        outputs = [
+            path
+            for path in _find_mosaic_outputs(job.project_dir)
+            if os.path.getmtime(path) >= job.started_at
+        ]
+        if not outputs:
+            if ctx:
+                await ctx.warning("No saved mosaic found to generate a preview for")
+            return
+        manifest = await asyncio.to_thread(_generate_tile_pyramid, outputs[0])
+        if ctx:
+            await ctx.info(_format_preview_summary(manifest))
+    except Exception as e:
+        if ctx:
+            await ctx.warning(f"Preview generation failed: {e}")
 
 
 @mcp.tool
 async def process_seestar_mosaic(
     project_dir: str,
     filter_type: Literal["broadband", "narrowband"] = "broadband",
+    timeout_seconds: float | None = None,
+    generate_preview: bool = False,
     ctx: Context = None,
 ) -> str:
     """
@@ -363,25 +1298,124 @@ async def process_seestar_mosaic(
     This function automatically creates the required SSF script files in your project
     directory, so you don't need to manually download them from the repository.
 
+    If the run exceeds timeout_seconds, or the client cancels the request, Siril and
+    everything it started are stopped and partial intermediates are removed.
+
     :param project_dir: path to your project root (must contain a 'lights/' subdir)
     :param filter_type: 'broadband' for UV/IR block or 'narrowband' for LP filter
+    :param timeout_seconds: maximum run time; 0 or less means no limit (defaults
+        to $SIRIL_MCP_JOB_TIMEOUT, or no limit)
+    :param generate_preview: also build a thumbnail and tile pyramid of the saved
+        mosaic (see generate_mosaic_preview)
     :returns: path to the resulting mosaic FIT
     """
+    job = SirilJob(project_dir, filter_type)
     if ctx:
         await ctx.info(f"Starting Seestar mosaic processing in {project_dir}")
         await ctx.info(f"Filter type: {filter_type}")
+        await ctx.info(f"Siril output is logged as job {job.job_id}")
 
     try:
-        result = _process_seestar_mosaic(project_dir, filter_type)
+        job, ssf_name, timeout = _register_mosaic_job(
+            project_dir, filter_type, job, timeout_seconds
+        )
+        # Wait for a slot on the event loop; only the run itself needs a thread
+        with _STAGE_DURATION.time(stage="queue"):
+            try:
+                acquired = await _job_manager.acquire(job)
+            except asyncio.CancelledError:
+                job.finish("cancelled")
+                raise
+        if not acquired:
+            job.finish("cancelled")
+            raise RuntimeError(f"Siril job {job.job_id} was cancelled while queued")
+        result = await _run_job_in_thread(job, ssf_name, timeout)
         if ctx:
             await ctx.info("Mosaic processing completed successfully")
+        if generate_preview:
+            await _preview_job_output(job, ctx)
         return result
+    except asyncio.CancelledError:
+        # The client went away: stop Siril now rather than letting it finish
+        job.cancel()
+        raise
     except Exception as e:
         if ctx:
             await ctx.error(f"Mosaic processing failed: {str(e)}")
         raise
 
 
+@mcp.tool
+def list_siril_jobs() -> str:
+    """
+    Lists the Siril jobs known to this server with their status.
+
+    :returns: one line per job, newest first
+    """
+    jobs = _job_manager.jobs()
+    if not jobs:
+        return "No Siril jobs have been run by this server"
+    lines = []
+    now = time.time()
+    for job in reversed(jobs):
+        start = job.started_at or job.created_at
+        elapsed = (job.finished_at or now) - start
+        lines.append(
+            f"{job.job_id}: {job.status} ({job.filter_type}, {elapsed:.0f}s) "
+            f"{job.project_dir}"
+        )
+    return "\n".join(lines)
+
+
+@mcp.tool
+def cancel_siril_job(job_id: str) -> str:
+    """
+    Cancels a queued or running Siril job. Siril and any processes it started
+    are stopped and the job's partial intermediates are removed.
+
+    :param job_id: id of the Siril job
+    :returns: confirmation message
+    """
+    job = _job_manager.get(job_id)
+    if not job.cancel():
+        return f"Job {job_id} has already finished ({job.status})"
+    return f"Cancellation requested for job {job_id}"
+
+
+@mcp.tool
+def tail_job_log(job_id: str, lines: int = 50) -> str:
+    """
+    Returns the last lines of a Siril job's log. The job id is reported when
+    processing starts and in the error message of a failed run.
+
+    :param job_id: id of the Siril job
+    :param lines: number of lines to return
+    :returns: the last lines of the job's output
+    """
+    tail = _tail_job_log(job_id, lines)
+    return "\n".join(tail) if tail else f"Log for job {job_id} is empty"
+
+
+@mcp.tool
+def search_job_log(
+    job_id: str, pattern: str, max_matches: int = 50, ignore_case: bool = True
+) -> str:
+    """
+    Searches a Siril job's log for a regular expression, returning the most
+    recent matching lines with their line numbers.
+
+    :param job_id: id of the Siril job
+    :param pattern: regular expression to search for
+    :param max_matches: maximum number of matching lines to return
+    :param ignore_case: whether the search is case-insensitive
+    :returns: matching lines prefixed with their line number
+    """
+    matches = _search_job_log(job_id, pattern, max_matches, ignore_case)
+    if not matches:
+        return f"No lines matching '{pattern}' in the log for job {job_id}"
+    return "\n".join(f"{number}: {line}" for number, line in matches)
+
+
 @mcp.tool
 def preprocess_with_gui(project_dir: str) -> str:
     """
@@ -397,41 +1431,198 @@ def preprocess_with_gui(project_dir: str) -> str:
     return f"Completed GUI-driven preprocessing in {project_dir}"
 
 
+SSF_BASE_URL = "https://raw.githubusercontent.com/naztronaut/siril-scripts/main/"
+# Cached scripts checked more recently than this are used without a request
+SSF_CACHE_MAX_AGE = 300
+SSF_FETCH_TIMEOUT = 30
+
+
+def _ssf_cache_dir() -> str:
+    """Returns the directory of the shared SSF script cache."""
+    return os.path.join(_cache_dir(), "ssf")
+
+
+def _load_cache_metadata(cache_path: str) -> dict:
+    """
+    Returns the metadata of a cached file, or {} if it is not cached or its
+    contents no longer match the hash recorded when it was fetched.
+    """
+    try:
+        with open(cache_path + ".json", encoding="utf-8") as f:
+            metadata = json.load(f)
+        with open(cache_path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except (OSError, ValueError):
+        return {}
+    return metadata if metadata.get("sha256") == digest else {}
+
+
+def _write_atomically(path: str, data: bytes, mode: int | None = None) -> None:
+    """
+    Replaces path with data in one step, optionally setting its permission
+    bits. The file gets a new inode, so existing hardlinks to the old file
+    keep the old contents.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+            if os.name == "nt" and os.path.exists(path):
+                # Windows won't replace a read-only file
+                os.chmod(path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+@_STAGE_DURATION.time(stage="ssf_fetch")
+def _fetch_to_cache(url: str, cache_path: str, max_age: float) -> str:
+    """
+    Makes sure cache_path holds the current contents of url.
+
+    A copy checked within max_age seconds is used as is; otherwise the server
+    is asked with If-None-Match/If-Modified-Since, so an unchanged script
+    costs a single 304 response. A cached copy whose contents no longer match
+    their recorded hash is downloaded again. Returns "fresh", "not modified"
+    or "downloaded".
+    """
+    metadata = _load_cache_metadata(cache_path)
+    if metadata and time.time() - metadata.get("checked_at", 0) < max_age:
+        return "fresh"
+
+    request = urllib.request.Request(url)
+    if metadata.get("etag"):
+        request.add_header("If-None-Match", metadata["etag"])
+    if metadata.get("last_modified"):
+        request.add_header("If-Modified-Since", metadata["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=SSF_FETCH_TIMEOUT) as response:
+            body = response.read()
+            _BYTES_PROCESSED.inc(len(body), operation="ssf_download")
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+        status = "downloaded"
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or not metadata:
+            raise
+        body = None
+        etag = e.headers.get("ETag") or metadata.get("etag")
+        last_modified = e.headers.get("Last-Modified") or metadata.get("last_modified")
+        status = "not modified"
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    if body is not None:
+        # Read-only, so nothing edits the shared copy in place
+        _write_atomically(cache_path, body, mode=0o444)
+    metadata = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "sha256": (
+            hashlib.sha256(body).hexdigest() if body is not None else metadata["sha256"]
+        ),
+        "checked_at": time.time(),
+    }
+    _write_atomically(cache_path + ".json", json.dumps(metadata).encode("utf-8"))
+    return status
+
+
+def _copy_if_changed(source: str, destination: str) -> None:
+    """
+    Copies source to destination unless it already has the same contents.
+    Projects get their own copy, so editing a project's script can't change
+    the cache or other projects.
+    """
+    with open(source, "rb") as f:
+        data = f.read()
+    try:
+        with open(destination, "rb") as f:
+            if f.read() == data and not os.path.samefile(source, destination):
+                return
+    except FileNotFoundError:
+        pass
+    if os.path.lexists(destination):
+        # Breaks hardlinks to the cache rather than writing through them
+        os.remove(destination)
+    with open(destination, "wb") as f:
+        f.write(data)
+
+
+async def _download_ssf_scripts(
+    project_dir: str,
+    base_url: str = SSF_BASE_URL,
+    max_age: float = SSF_CACHE_MAX_AGE,
+    cache_dir: str | None = None,
+) -> dict[str, str]:
+    """
+    Internal function that refreshes the shared SSF script cache and copies the
+    scripts into project_dir. All scripts are fetched concurrently.
+
+    If a script can't be fetched, the cached copy is used, or the embedded
+    version if there is none. Returns how each script was obtained.
+    """
+    if not os.path.isdir(project_dir):
+        raise FileNotFoundError(f"Project directory '{project_dir}' does not exist")
+    cache_dir = cache_dir or _ssf_cache_dir()
+
+    async def fetch(filter_type: str, script_name: str) -> str:
+        cache_path = os.path.join(cache_dir, script_name)
+        project_path = os.path.join(project_dir, script_name)
+        try:
+            status = await asyncio.to_thread(
+                _fetch_to_cache, base_url + script_name, cache_path, max_age
+            )
+            _CACHE_REQUESTS.inc(
+                cache="ssf", result="miss" if status == "downloaded" else "hit"
+            )
+        except Exception as e:
+            _CACHE_REQUESTS.inc(cache="ssf", result="error")
+            if not os.path.isfile(cache_path):
+                with open(project_path, "w", encoding="utf-8") as f:
+                    f.write(SSF_SCRIPT_CONTENTS[filter_type])
+                return f"fallback ({e})"
+            status = f"cached copy, refresh failed ({e})"
+        _copy_if_changed(cache_path, project_path)
+        return status
+
+    statuses = await asyncio.gather(
+        *(fetch(filter_type, name) for filter_type, name in SSF_SCRIPTS.items())
+    )
+    return dict(zip(SSF_SCRIPTS.values(), statuses))
+
+
 @mcp.tool
-async def download_latest_ssf_scripts(project_dir: str, ctx: Context) -> str:
+async def download_latest_ssf_scripts(
+    project_dir: str, force_refresh: bool = False, ctx: Context = None
+) -> str:
     """
     Downloads the latest SSF script files from the naztronaut/siril-scripts repository
     and saves them to your project directory. This ensures you have the most up-to-date
     versions of the Siril scripts.
 
+    Scripts are kept in a shared cache and revalidated with conditional requests, so
+    repeated calls transfer nothing unless a script has changed.
+
     :param project_dir: path to your project root where scripts will be saved
+    :param force_refresh: revalidate the cached scripts even if recently checked
     :returns: confirmation message with script locations
     """
-    import urllib.request
-
-    await ctx.info(f"Downloading latest SSF scripts to {project_dir}")
-    base_url = "https://raw.githubusercontent.com/naztronaut/siril-scripts/main/"
-    scripts_downloaded = []
-
-    for filter_type, script_name in SSF_SCRIPTS.items():
-        try:
-            script_url = base_url + script_name
-            script_path = os.path.join(project_dir, script_name)
-
-            await ctx.info(f"Downloading {script_name} from {script_url}")
-            urllib.request.urlretrieve(script_url, script_path)
-            scripts_downloaded.append(script_name)
+    if ctx:
+        await ctx.info(f"Downloading latest SSF scripts to {project_dir}")
+    statuses = await _download_ssf_scripts(
+        project_dir, max_age=0 if force_refresh else SSF_CACHE_MAX_AGE
+    )
+    for script_name, status in statuses.items():
+        if ctx and status.startswith(("fallback", "cached copy")):
+            await ctx.warning(f"Could not download {script_name}: using {status}")
 
-        except Exception as e:
-            await ctx.warning(f"Failed to download {script_name}: {e}")
-            # Fall back to embedded version
-            await ctx.info(f"Creating fallback version of {script_name}")
-            with open(script_path, "w", encoding="utf-8") as f:
-                f.write(SSF_SCRIPT_CONTENTS[filter_type])
-            scripts_downloaded.append(f"{script_name} (fallback)")
-
-    result = f"Downloaded scripts to {project_dir}: {', '.join(scripts_downloaded)}"
-    await ctx.info("Script download completed")
+    scripts = [f"{name} ({status})" for name, status in statuses.items()]
+    result = f"Downloaded scripts to {project_dir}: {', '.join(scripts)}"
+    if ctx:
+        await ctx.info("Script download completed")
     return result
 
 
@@ -505,9 +1696,1183 @@ def check_project_structure(project_dir: str) -> str:
     return "\n".join(analysis)
 
 
-def main():
+# FITS primary headers are a sequence of 2880-byte blocks of 80-char cards
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+_FITS_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+# Image statistics are computed tile by tile so memory use does not depend on
+# the size of the mosaic.
+STATS_TILE_SIZE = 512
+STATS_HISTOGRAM_BINS = 64
+STAR_DETECTION_SIGMA = 5.0
+# Stars must stand out from the median of the pixels this far away
+STAR_RING_RADIUS = 5
+# Tiles with fewer valid pixels than this don't contribute a background estimate
+_MIN_TILE_PIXELS = 64
+# Scale factor from median absolute deviation to Gaussian sigma
+_MAD_TO_SIGMA = 1.4826
+
+
+def _require_numpy():
+    """Imports numpy, raising a helpful error if it is not installed."""
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError(
+            "This tool requires numpy. Install it with: "
+            "pip install 'siril-mcp[analysis]'"
+        ) from e
+    return numpy
+
+
+def _parse_fits_value(text: str):
+    """Parses the value field of a FITS header card."""
+    text = text.strip()
+    if text.startswith("'"):
+        # Quoted string; a doubled quote is an escaped quote
+        chars = []
+        i = 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1 : i + 2] != "'":
+                    break
+                i += 1
+            chars.append(text[i])
+            i += 1
+        return "".join(chars).rstrip()
+    text = text.split("/", 1)[0].strip()
+    if text in ("T", "F"):
+        return text == "T"
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text.replace("D", "E"))
+    except ValueError:
+        return text
+
+
+def _read_fits_header(path: str) -> tuple[dict, int]:
+    """
+    Reads the primary header of a FITS file without touching its pixel data.
+    Returns the header keywords and the byte offset where the data starts.
+    """
+    header = {}
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            block = f.read(FITS_BLOCK_SIZE)
+            if offset == 0 and not block.startswith(b"SIMPLE  ="):
+                raise ValueError(f"{path} is not a FITS file")
+            if len(block) < FITS_BLOCK_SIZE:
+                raise ValueError(f"{path} has a truncated FITS header")
+            offset += FITS_BLOCK_SIZE
+            for start in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+                card = block[start : start + FITS_CARD_SIZE].decode(
+                    "ascii", errors="replace"
+                )
+                keyword = card[:8].strip()
+                if keyword == "END":
+                    return header, offset
+                if card[8:10] == "= ":
+                    header[keyword] = _parse_fits_value(card[10:])
+
+
+def _open_fits_image(path: str):
+    """
+    Memory-maps the primary image of a FITS file.
+    Returns the header and a read-only (channels, height, width) array of raw,
+    unscaled pixel values; nothing is read until the array is sliced.
+    """
+    np = _require_numpy()
+    header, offset = _read_fits_header(path)
+    naxis = header.get("NAXIS", 0)
+    if naxis not in (2, 3):
+        raise ValueError(f"{path} does not contain a 2D or 3D image (NAXIS={naxis})")
+    dtype = _FITS_DTYPES.get(header.get("BITPIX"))
+    if dtype is None:
+        raise ValueError(f"{path} has an unsupported BITPIX {header.get('BITPIX')}")
+    channels = header.get("NAXIS3", 1) if naxis == 3 else 1
+    shape = (channels, header["NAXIS2"], header["NAXIS1"])
+    data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return header, data
+
+
+def _read_fits_tile(data, header: dict, channel: int, rows: slice, cols: slice):
+    """Reads one tile of a memory-mapped image as float32 physical values."""
+    tile = data[channel, rows, cols].astype("float32")
+    bscale = header.get("BSCALE", 1)
+    bzero = header.get("BZERO", 0)
+    if bscale != 1:
+        tile *= bscale
+    if bzero:
+        tile += bzero
+    return tile
+
+
+def _iter_tiles(height: int, width: int, tile_size: int):
+    """Yields (rows, cols) slices covering an image in tile_size squares."""
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield slice(y, min(y + tile_size, height)), slice(
+                x, min(x + tile_size, width)
+            )
+
+
+def _valid_pixels(tile):
+    np = _require_numpy()
+    # Mosaics framed with -framing=max are padded with zeros outside the data
+    return tile[np.isfinite(tile) & (tile != 0)]
+
+
+def _robust_background(values) -> tuple[float, float]:
+    """Returns a star-rejecting (median, sigma) estimate for a set of pixels."""
+    np = _require_numpy()
+    median = float(np.median(values))
+    sigma = _MAD_TO_SIGMA * float(np.median(np.abs(values - median)))
+    if sigma > 0:
+        clipped = values[np.abs(values - median) < 3 * sigma]
+        if clipped.size:
+            median = float(np.median(clipped))
+            sigma = _MAD_TO_SIGMA * float(np.median(np.abs(clipped - median)))
+    return median, sigma
+
+
+def _histogram_percentile(counts, edges, fraction: float) -> float:
+    """Returns the value below which the given fraction of histogram counts lie."""
+    np = _require_numpy()
+    cumulative = np.cumsum(counts)
+    if not cumulative.size or cumulative[-1] == 0:
+        return float("nan")
+    target = fraction * cumulative[-1]
+    index = int(np.searchsorted(cumulative, target))
+    return float(edges[min(index + 1, len(edges) - 1)])
+
+
+def _count_stars(luminance, threshold: float, min_excess: float) -> int:
+    """
+    Counts stars in a luminance tile carrying a STAR_RING_RADIUS pixel halo
+    that is not counted: pixels above threshold that are the maximum of
+    their 3x3 neighbourhood and stand min_excess above the median of the
+    ring of pixels STAR_RING_RADIUS away, their local background. Ties are
+    broken in raster order so a flat-topped star counts once. The ring keeps
+    the edges of bright extended regions (nebulae, gradients, galaxy cores)
+    from counting as stars.
+    """
+    np = _require_numpy()
+    r = STAR_RING_RADIUS
+    height, width = luminance.shape
+    core = luminance[r:-r, r:-r]
+    peaks = core > threshold
+    for dy, dx in ((-1, -1), (-1, 0), (-1, 1), (0, -1)):
+        peaks &= core > luminance[r + dy : height - r + dy, r + dx : width - r + dx]
+    for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1)):
+        peaks &= core >= luminance[r + dy : height - r + dy, r + dx : width - r + dx]
+    ys, xs = np.nonzero(peaks)
+    if not ys.size:
+        return 0
+
+    ring = [(dy, dx) for dy in range(-r, r + 1) for dx in (-r, r)]
+    ring += [(dy, dx) for dy in (-r, r) for dx in range(-r + 1, r)]
+    dy, dx = np.array(ring).T
+    samples = luminance[ys[:, None] + r + dy, xs[:, None] + r + dx]
+    samples[~np.isfinite(samples)] = np.nan
+    # A ring entirely outside the valid data leaves only the tile threshold
+    known = ~np.isnan(samples).all(axis=1)
+    excess = np.full(ys.size, np.inf)
+    excess[known] = core[ys[known], xs[known]] - np.nanmedian(samples[known], axis=1)
+    return int(np.count_nonzero(excess > min_excess))
+
+
+def _read_luminance_tile(data, header, rows: slice, cols: slice, halo: int = 1):
+    """
+    Reads the channel mean of a tile plus a halo of halo pixels; invalid
+    pixels and the halo outside the image are set to -inf.
+    """
+    np = _require_numpy()
+    channels, height, width = data.shape
+    y0, y1 = max(rows.start - halo, 0), min(rows.stop + halo, height)
+    x0, x1 = max(cols.start - halo, 0), min(cols.stop + halo, width)
+    luminance = sum(
+        _read_fits_tile(data, header, c, slice(y0, y1), slice(x0, x1))
+        for c in range(channels)
+    ) / np.float32(channels)
+    luminance[~np.isfinite(luminance) | (luminance == 0)] = -np.inf
+    return np.pad(
+        luminance,
+        (
+            (y0 - rows.start + halo, rows.stop + halo - y1),
+            (x0 - cols.start + halo, cols.stop + halo - x1),
+        ),
+        constant_values=-np.inf,
+    )
+
+
+def _scan_tile_statistics(data, header: dict, tile_size: int):
+    """
+    Reads a memory-mapped image once, tile by tile, and returns per-channel
+    arrays (minimum, maximum, total, count, background, noise) of its valid
+    pixels. Background and noise are the medians of each tile's star-rejecting
+    estimate. Also returns each tile's luminance background, keyed by the
+    tile's (row, column) origin.
+    """
+    np = _require_numpy()
+    channels, height, width = data.shape
+    minimum = np.full(channels, np.inf)
+    maximum = np.full(channels, -np.inf)
+    total = np.zeros(channels)
+    count = np.zeros(channels, dtype=np.int64)
+    tile_medians = [[] for _ in range(channels)]
+    tile_sigmas = [[] for _ in range(channels)]
+    tile_backgrounds = {}
+    for rows, cols in _iter_tiles(height, width, tile_size):
+        medians = []
+        for c in range(channels):
+            values = _valid_pixels(_read_fits_tile(data, header, c, rows, cols))
+            if not values.size:
+                continue
+            minimum[c] = min(minimum[c], float(values.min()))
+            maximum[c] = max(maximum[c], float(values.max()))
+            total[c] += float(values.sum(dtype=np.float64))
+            count[c] += values.size
+            if values.size >= _MIN_TILE_PIXELS:
+                median, sigma = _robust_background(values)
+                tile_medians[c].append(median)
+                tile_sigmas[c].append(sigma)
+                medians.append(median)
+        if len(medians) == channels:
+            tile_backgrounds[rows.start, cols.start] = sum(medians) / channels
+
+    background = np.array(
+        [np.median(m) if m else np.nan for m in tile_medians], dtype=np.float64
+    )
+    noise = np.array(
+        [np.median(s) if s else np.nan for s in tile_sigmas], dtype=np.float64
+    )
+    return minimum, maximum, total, count, background, noise, tile_backgrounds
+
+
+@_STAGE_DURATION.time(stage="analyze")
+def _compute_fits_statistics(
+    path: str,
+    tile_size: int = STATS_TILE_SIZE,
+    bins: int = STATS_HISTOGRAM_BINS,
+    detection_sigma: float = STAR_DETECTION_SIGMA,
+) -> dict:
+    """
+    Internal function computing image statistics for a FITS mosaic.
+
+    The pixel data is memory-mapped and read in two passes of tile_size
+    tiles, so at most a few tiles are held in memory at once:
+    1. per-channel range, mean, and a star-rejecting background/noise
+       estimate per tile (the medians over all tiles are reported)
+    2. per-channel histograms, and a star count: local maxima of the channel
+       mean that are detection_sigma noise above both their tile's background
+       and their local background (see _count_stars)
+
+    Zero and non-finite pixels (mosaic padding) are ignored. SNR is the 99.9th
+    percentile of a channel over its background, in units of its noise.
+    """
+    np = _require_numpy()
+    header, data = _open_fits_image(path)
+    _BYTES_PROCESSED.inc(data.nbytes, operation="analyze")
+    channels, height, width = data.shape
+
+    (
+        minimum,
+        maximum,
+        total,
+        count,
+        background,
+        noise,
+        tile_backgrounds,
+    ) = _scan_tile_statistics(data, header, tile_size)
+
+    histograms = np.zeros((channels, bins), dtype=np.int64)
+    ranges = [
+        (minimum[c], maximum[c]) if count[c] else (0.0, 1.0) for c in range(channels)
+    ]
+    # Noise of the channel mean, assuming independent channel noise
+    luminance_background = float(np.nanmean(background)) if count.any() else 0.0
+    luminance_noise = (
+        float(np.sqrt(np.nansum(noise**2))) / channels if count.any() else 0.0
+    )
+    min_excess = detection_sigma * luminance_noise
+    stars = 0
+    for rows, cols in _iter_tiles(height, width, tile_size):
+        for c in range(channels):
+            values = _valid_pixels(_read_fits_tile(data, header, c, rows, cols))
+            if values.size:
+                histograms[c] += np.histogram(values, bins=bins, range=ranges[c])[0]
+        if count.any() and luminance_noise > 0:
+            # Each tile is compared with its own background, not the global one
+            tile_background = tile_backgrounds.get(
+                (rows.start, cols.start), luminance_background
+            )
+            luminance = _read_luminance_tile(
+                data, header, rows, cols, halo=STAR_RING_RADIUS
+            )
+            stars += _count_stars(luminance, tile_background + min_excess, min_excess)
+
+    channel_stats = []
+    for c in range(channels):
+        edges = np.linspace(ranges[c][0], ranges[c][1], bins + 1)
+        p999 = _histogram_percentile(histograms[c], edges, 0.999)
+        snr = (p999 - background[c]) / noise[c] if noise[c] > 0 else float("nan")
+        channel_stats.append(
+            {
+                "min": float(minimum[c]) if count[c] else float("nan"),
+                "max": float(maximum[c]) if count[c] else float("nan"),
+                "mean": float(total[c] / count[c]) if count[c] else float("nan"),
+                "background": float(background[c]),
+                "noise": float(noise[c]),
+                "snr": float(snr),
+                "valid_pixels": int(count[c]),
+                "histogram": histograms[c].tolist(),
+                "histogram_range": (float(ranges[c][0]), float(ranges[c][1])),
+            }
+        )
+
+    return {
+        "path": path,
+        "width": width,
+        "height": height,
+        "channels": channels,
+        "bitpix": header.get("BITPIX"),
+        "object": header.get("OBJECT"),
+        "stars": stars,
+        "detection_sigma": detection_sigma,
+        "channel_stats": channel_stats,
+    }
+
+
+def _find_mosaic_outputs(project_dir: str) -> list[str]:
+    """
+    Returns the mosaics saved by the SSF scripts in a project root (the
+    ``*_SPCC`` and ``*_og`` FITS files), newest first.
+    """
+    outputs = []
+    for name in os.listdir(project_dir):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() in (".fit", ".fits", ".fts") and stem.endswith(("_SPCC", "_og")):
+            outputs.append(os.path.join(project_dir, name))
+    return sorted(outputs, key=os.path.getmtime, reverse=True)
+
+
+def _resolve_mosaic_path(path: str) -> str:
+    """Resolves a FITS path, or a project dir to its newest saved mosaic."""
+    if os.path.isdir(path):
+        outputs = _find_mosaic_outputs(path)
+        if not outputs:
+            raise FileNotFoundError(f"No _SPCC or _og mosaic found in {path}")
+        return outputs[0]
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"FITS file not found: {path}")
+    return path
+
+
+@mcp.tool
+async def analyze_mosaic(
+    path: str,
+    detection_sigma: float = STAR_DETECTION_SIGMA,
+    ctx: Context = None,
+) -> str:
+    """
+    Computes quality statistics for a processed mosaic: per-channel range,
+    histogram, background, noise and SNR estimates, plus a star count.
+    The image is memory-mapped and processed in tiles, so memory use stays
+    bounded however large the mosaic is.
+
+    :param path: a saved _og/_SPCC FITS file, or a project dir (its newest one is used)
+    :param detection_sigma: detection threshold for stars, in noise sigmas above background
+    :returns: statistics report
+    """
+    fits_path = _resolve_mosaic_path(path)
+    if ctx:
+        await ctx.info(f"Analyzing {fits_path}")
+    stats = await asyncio.to_thread(
+        _compute_fits_statistics, fits_path, detection_sigma=detection_sigma
+    )
+
+    names = ["R", "G", "B"] if stats["channels"] == 3 else ["L"] * stats["channels"]
+    report = [
+        f"📊 Statistics for {fits_path}",
+        f"Object: {stats['object'] or 'unknown'}",
+        f"Size: {stats['width']} x {stats['height']} px, "
+        f"{stats['channels']} channel(s), BITPIX {stats['bitpix']}",
+        f"⭐ Stars detected (>{stats['detection_sigma']:g}σ): {stats['stars']}",
+    ]
+    for name, channel in zip(names, stats["channel_stats"]):
+        low, high = channel["histogram_range"]
+        report.append(
+            f"\n{name}: min {channel['min']:.6g}, max {channel['max']:.6g}, "
+            f"mean {channel['mean']:.6g}\n"
+            f"   background {channel['background']:.6g}, "
+            f"noise {channel['noise']:.6g}, SNR {channel['snr']:.1f}\n"
+            f"   histogram ({len(channel['histogram'])} bins, "
+            f"{low:.6g} to {high:.6g}): "
+            f"{' '.join(str(n) for n in channel['histogram'])}"
+        )
+    return "\n".join(report)
+
+
+# Preview pyramids are streamed from the mosaic one block of tile rows at a
+# time; each zoom level only buffers a single row of tiles.
+PREVIEW_TILE_SIZE = 256
+PREVIEW_THUMBNAIL_SIZE = 256
+# Autostretch parameters, as used by Siril's autostretch command
+AUTOSTRETCH_SHADOWS_CLIP = -2.8
+AUTOSTRETCH_TARGET_BACKGROUND = 0.25
+
+
+def _write_png(path: str, pixels) -> None:
+    """Writes an 8-bit grayscale (h, w) or RGB (h, w, 3) array as a PNG."""
+    np = _require_numpy()
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    # Each scanline is prefixed with filter type 0 (none)
+    raw = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(kind: bytes, payload: bytes) -> bytes:
+        crc = zlib.crc32(kind + payload) & 0xFFFFFFFF
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", crc)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(
+            chunk(
+                b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+            )
+        )
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def _midtones_transfer(x, midtones: float):
+    """Applies the midtones transfer function used by Siril's autostretch."""
+    return (midtones - 1) * x / ((2 * midtones - 1) * x - midtones)
+
+
+def _autostretch_parameters(
+    background, noise, scale: float
+) -> list[tuple[float, float]]:
+    """
+    Returns per-channel (shadows, midtones) for an unlinked autostretch, from
+    each channel's background and noise in pixel units divided by scale.
+    """
+    parameters = []
+    for bg, sigma in zip(background, noise):
+        if not (math.isfinite(bg) and math.isfinite(sigma)):
+            # The channel has no valid pixels
+            parameters.append((0.0, 0.5))
+            continue
+        bg, sigma = bg / scale, sigma / scale
+        shadows = min(max(bg + AUTOSTRETCH_SHADOWS_CLIP * sigma, 0.0), 0.99)
+        normalized_bg = (bg - shadows) / (1 - shadows)
+        midtones = (
+            float(_midtones_transfer(normalized_bg, AUTOSTRETCH_TARGET_BACKGROUND))
+            if 0 < normalized_bg < 1
+            else 0.5
+        )
+        parameters.append((shadows, midtones))
+    return parameters
+
+
+def _pyramid_levels(width: int, height: int, tile_size: int, thumbnail_size: int):
+    """
+    Returns the (width, height) of each pyramid level, full resolution first,
+    halving until the image fits both a single tile and the thumbnail size.
+    """
+    levels = [(width, height)]
+    while max(levels[-1]) > min(tile_size, thumbnail_size):
+        w, h = levels[-1]
+        levels.append(((w + 1) // 2, (h + 1) // 2))
+    return levels
+
+
+class _PyramidLevel:
+    """
+    One zoom level of a tile pyramid being streamed top to bottom.
+
+    Rows pushed into the level are written out as soon as a full row of tiles
+    is available, and averaged 2x2 into the next (coarser) level.
+    """
+
+    def __init__(self, zoom, width, height, tile_size, output_dir, coarser=None):
+        self.zoom = zoom
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.directory = os.path.join(output_dir, str(zoom))
+        self.coarser = coarser
+        self.keep_image = False
+        self.image_rows = []
+        self._pending = []
+        self._pending_rows = 0
+        self._tile_row = 0
+        self._odd_row = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def push(self, rows) -> None:
+        """Adds a (n, width, channels) block of stretched rows, top to bottom."""
+        np = _require_numpy()
+        self._pending.append(rows)
+        self._pending_rows += rows.shape[0]
+        while self._pending_rows >= self.tile_size:
+            block = np.concatenate(self._pending)
+            self._write_tile_row(block[: self.tile_size])
+            self._pending = [block[self.tile_size :]]
+            self._pending_rows = block.shape[0] - self.tile_size
+
+        if self.coarser is not None:
+            if self._odd_row is not None:
+                rows = np.concatenate([self._odd_row, rows])
+                self._odd_row = None
+            if rows.shape[0] % 2:
+                self._odd_row = rows[-1:]
+                rows = rows[:-1]
+            if rows.shape[0]:
+                self.coarser.push(self._downsample(rows))
+
+    def flush(self) -> None:
+        """Writes the last, partial row of tiles and flushes coarser levels."""
+        np = _require_numpy()
+        if self._pending_rows:
+            self._write_tile_row(np.concatenate(self._pending))
+            self._pending = []
+            self._pending_rows = 0
+        if self.coarser is not None:
+            if self._odd_row is not None:
+                self.coarser.push(self._downsample(self._odd_row))
+                self._odd_row = None
+            self.coarser.flush()
+
+    def _downsample(self, rows):
+        np = _require_numpy()
+        if rows.shape[0] % 2:
+            rows = np.concatenate([rows, rows[-1:]])
+        if rows.shape[1] % 2:
+            rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+        return (
+            rows[0::2, 0::2] + rows[1::2, 0::2] + rows[0::2, 1::2] + rows[1::2, 1::2]
+        ) / 4
+
+    def _write_tile_row(self, block) -> None:
+        np = _require_numpy()
+        pixels = (np.clip(block, 0, 1) * 255 + 0.5).astype(np.uint8)
+        if pixels.shape[2] == 1:
+            pixels = pixels[:, :, 0]
+        for column, x in enumerate(range(0, self.width, self.tile_size)):
+            _write_png(
+                os.path.join(self.directory, f"{column}_{self._tile_row}.png"),
+                pixels[:, x : x + self.tile_size],
+            )
+        if self.keep_image:
+            self.image_rows.append(pixels)
+        self._tile_row += 1
+
+
+def _read_stretched_rows(data, header, rows: slice, parameters, scale: float):
+    """
+    Reads a block of image rows and returns them autostretched to [0, 1] as a
+    (n, width, channels) array, flipped so the top of the image comes first.
+    """
+    np = _require_numpy()
+    channels = []
+    for c, (shadows, midtones) in enumerate(parameters):
+        values = _read_fits_tile(data, header, c, rows, slice(None))[::-1]
+        values = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0) / scale
+        values = np.clip((values - shadows) / (1 - shadows), 0, 1)
+        channels.append(_midtones_transfer(values, midtones))
+    return np.stack(channels, axis=-1).astype(np.float32)
+
+
+def _clear_previous_pyramid(output_dir: str) -> None:
+    """Removes tiles of a previously generated pyramid from output_dir."""
+    if not os.path.isfile(os.path.join(output_dir, "pyramid.json")):
+        return
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name.isdigit() and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name in ("pyramid.json", "thumbnail.png"):
+            os.remove(path)
+
+
+@_STAGE_DURATION.time(stage="preview")
+def _generate_tile_pyramid(
+    path: str,
+    output_dir: str | None = None,
+    tile_size: int = PREVIEW_TILE_SIZE,
+    thumbnail_size: int = PREVIEW_THUMBNAIL_SIZE,
+) -> dict:
+    """
+    Internal function generating an autostretched PNG tile pyramid and a
+    thumbnail for a FITS mosaic.
+
+    Tiles are written to ``<output_dir>/<zoom>/<column>_<row>.png``, where
+    zoom 0 is the coarsest level and the highest zoom is full resolution.
+    The image is memory-mapped and streamed in blocks of tile_size rows, so
+    memory use depends on the image width, not its size. Returns the
+    manifest that is also saved as ``pyramid.json``.
+    """
+    np = _require_numpy()
+    if tile_size < 16 or thumbnail_size < 16:
+        raise ValueError("tile_size and thumbnail_size must be at least 16 pixels")
+    header, data = _open_fits_image(path)
+    _BYTES_PROCESSED.inc(data.nbytes, operation="preview")
+    channels, height, width = data.shape
+    if channels not in (1, 3):
+        raise ValueError(f"{path} has {channels} channels; expected 1 or 3")
+    if output_dir is None:
+        output_dir = os.path.splitext(path)[0] + "_tiles"
+    os.makedirs(output_dir, exist_ok=True)
+    _clear_previous_pyramid(output_dir)
+
+    _, maximum, _, _, background, noise, _ = _scan_tile_statistics(
+        data, header, STATS_TILE_SIZE
+    )
+    # Float mosaics are normalized to [0, 1]; integer ones use their full range
+    scale = max(float(np.nanmax(maximum)), 1.0) if np.isfinite(maximum).any() else 1.0
+    parameters = _autostretch_parameters(background, noise, scale)
+
+    sizes = _pyramid_levels(width, height, tile_size, thumbnail_size)
+    top_zoom = len(sizes) - 1
+    levels = []
+    coarser = None
+    for index in range(top_zoom, -1, -1):
+        w, h = sizes[index]
+        coarser = _PyramidLevel(top_zoom - index, w, h, tile_size, output_dir, coarser)
+        levels.append(coarser)
+    levels.reverse()
+    # The first level that fits the thumbnail size is kept whole
+    thumbnail_level = next(
+        level for level in levels if max(level.width, level.height) <= thumbnail_size
+    )
+    thumbnail_level.keep_image = True
+
+    for stop in range(height, 0, -tile_size):
+        rows = slice(max(stop - tile_size, 0), stop)
+        levels[0].push(_read_stretched_rows(data, header, rows, parameters, scale))
+    levels[0].flush()
+
+    thumbnail_path = os.path.join(output_dir, "thumbnail.png")
+    _write_png(thumbnail_path, np.concatenate(thumbnail_level.image_rows))
+
+    manifest = {
+        "source": os.path.abspath(path),
+        "width": width,
+        "height": height,
+        "tile_size": tile_size,
+        "format": "png",
+        "thumbnail": "thumbnail.png",
+        "levels": [
+            {
+                "zoom": level.zoom,
+                "width": level.width,
+                "height": level.height,
+                "columns": -(-level.width // tile_size),
+                "rows": -(-level.height // tile_size),
+            }
+            for level in sorted(levels, key=lambda level: level.zoom)
+        ],
+    }
+    with open(os.path.join(output_dir, "pyramid.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    manifest["output_dir"] = output_dir
+    return manifest
+
+
+def _format_preview_summary(manifest: dict) -> str:
+    output_dir = manifest["output_dir"]
+    return (
+        f"🖼️ Preview for {manifest['source']}\n"
+        f"Thumbnail: {os.path.join(output_dir, manifest['thumbnail'])}\n"
+        f"Tile pyramid: {len(manifest['levels'])} levels of "
+        f"{manifest['tile_size']}px PNG tiles in {output_dir}/<zoom>/<column>_<row>.png "
+        f"(zoom {manifest['levels'][-1]['zoom']} is full resolution)\n"
+        f"Manifest: {os.path.join(output_dir, 'pyramid.json')}"
+    )
+
+
+@mcp.tool
+async def generate_mosaic_preview(
+    path: str,
+    output_dir: str | None = None,
+    tile_size: int = PREVIEW_TILE_SIZE,
+    thumbnail_size: int = PREVIEW_THUMBNAIL_SIZE,
+    ctx: Context = None,
+) -> str:
+    """
+    Generates an autostretched thumbnail and a multi-resolution PNG tile pyramid
+    for a processed mosaic, so clients can preview it and zoom in without
+    reading the full FITS file.
+
+    :param path: a saved _og/_SPCC FITS file, or a project dir (its newest one is used)
+    :param output_dir: where to write the pyramid (defaults to '<fits name>_tiles')
+    :param tile_size: tile width and height in pixels
+    :param thumbnail_size: maximum thumbnail width and height in pixels
+    :returns: location of the thumbnail and the pyramid manifest
+    """
+    fits_path = _resolve_mosaic_path(path)
+    if ctx:
+        await ctx.info(f"Generating preview pyramid for {fits_path}")
+    manifest = await asyncio.to_thread(
+        _generate_tile_pyramid, fits_path, output_dir, tile_size, thumbnail_size
+    )
+    return _format_preview_summary(manifest)
+
+
+# Frames are ingested by a thread pool; hashes are computed while copying, or
+# when a frame has the same size as one already in the destination.
+INGEST_WORKERS = 4
+# Upper bound on workers, since any client of a shared server can ask for them
+INGEST_MAX_WORKERS = 32
+INGEST_HASH_CHUNK_SIZE = 1024 * 1024
+# Per lights/ directory record of frame hashes and ingested source files
+INGEST_MANIFEST = ".siril-mcp-ingest.json"
+FITS_EXTENSIONS = (".fit", ".fits", ".fts")
+# Linux ioctl that shares a file's extents with another (a reflink)
+_FICLONE = 0x40049409
+_CAN_REFLINK = fcntl is not None and sys.platform.startswith("linux")
+
+
+def _file_digest(path: str) -> str:
+    """Returns the BLAKE2b hash of a file's contents, read in chunks."""
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while chunk := f.read(INGEST_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _target_dir_name(target) -> str:
+    """Returns a directory name for a FITS OBJECT value."""
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", str(target or "")).strip("._")
+    return name or "unknown_target"
+
+
+def _copy_with_digest(source: str, destination: str) -> str:
+    """
+    Copies source to a new destination file with its metadata, hashing the
+    data on the way through. Returns the BLAKE2b hash of the contents.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(source, "rb") as src, open(destination, "xb") as dst:
+        while chunk := src.read(INGEST_HASH_CHUNK_SIZE):
+            digest.update(chunk)
+            dst.write(chunk)
+    shutil.copystat(source, destination)
+    return digest.hexdigest()
+
+
+def _clone_file(source: str, destination: str) -> tuple[str, str | None]:
+    """
+    Creates destination, which must not exist yet, with the contents of
+    source as cheaply as possible: a reflink or a hardlink when both are on
+    the same filesystem, otherwise a copy. Returns the method used
+    ("reflink", "hardlink" or "copy") and, for a copy, the hash of the
+    contents computed while copying (None otherwise).
+    """
+    if os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+        if _CAN_REFLINK:
+            try:
+                with open(source, "rb") as src, open(destination, "xb") as dst:
+                    fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                shutil.copystat(source, destination)
+                return "reflink", None
+            except OSError:
+                if os.path.lexists(destination):
+                    os.remove(destination)
+        try:
+            os.link(source, destination)
+            return "hardlink", None
+        except OSError:
+            pass
+    return "copy", _copy_with_digest(source, destination)
+
+
+class _LightsIndex:
+    """
+    The frames in one lights/ directory, used to deduplicate ingestion.
+
+    A manifest in the directory records each frame's size and content hash,
+    and which source files were ingested as which frame. Unchanged source
+    files that were ingested before are recognized without being read again.
+    Other frames are staged into the directory first and, when a frame of the
+    same size exists, hashed from the local staged copy, so a source is read
+    at most once. Hashing never happens while holding the lock.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.manifest_path = os.path.join(directory, INGEST_MANIFEST)
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        recorded = manifest.get("files", {})
+        self.sources: dict[str, dict] = manifest.get("sources", {})
+        self.files: dict[str, dict] = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.lower().endswith(FITS_EXTENSIONS) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                frame = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+                old = recorded.get(name, {})
+                unchanged = all(old.get(k) == v for k, v in frame.items())
+                frame["digest"] = old.get("digest") if unchanged else None
+                self.files[name] = frame
+
+    def is_ingested(self, path: str, stat: os.stat_result) -> bool:
+        """Returns whether this unchanged source file was ingested before."""
+        with self.lock:
+            source = self.sources.get(os.path.abspath(path))
+            return bool(
+                source
+                and source["size"] == stat.st_size
+                and source["mtime_ns"] == stat.st_mtime_ns
+                and self.files.get(source.get("name"), {}).get("size") == stat.st_size
+            )
+
+    def _unique_name(self, name: str) -> str:
+        stem, ext = os.path.splitext(name)
+        candidate, number = name, 1
+        while candidate in self.files or os.path.lexists(
+            os.path.join(self.directory, candidate)
+        ):
+            candidate = f"{stem}_{number}{ext}"
+            number += 1
+        return candidate
+
+    def add(
+        self, path: str, stat: os.stat_result, staged: str, digest: str | None
+    ) -> str | None:
+        """
+        Moves staged, a complete copy of the source file path, into place and
+        returns its frame name. Returns None, leaving staged where it is, if a
+        frame with the same size and contents is already present. digest is
+        the staged file's hash, if already known.
+        """
+        size = stat.st_size
+        while True:
+            with self.lock:
+                same_size = {
+                    name: frame
+                    for name, frame in self.files.items()
+                    if frame["size"] == size
+                }
+                unhashed = [
+                    name for name, frame in same_size.items() if frame["digest"] is None
+                ]
+                if not same_size or (digest is not None and not unhashed):
+                    for name, frame in same_size.items():
+                        if frame["digest"] == digest:
+                            self._record_source(path, stat, name, digest)
+                            return None
+                    name = self._unique_name(os.path.basename(path))
+                    destination = os.path.join(self.directory, name)
+                    os.replace(staged, destination)
+                    self.files[name] = {
+                        "size": size,
+                        "mtime_ns": os.stat(destination).st_mtime_ns,
+                        "digest": digest,
+                    }
+                    self._record_source(path, stat, name, digest)
+                    return name
+
+            # Hash outside the lock, then check again with the new hashes
+            if digest is None:
+                digest = _file_digest(staged)
+            for name in unhashed:
+                frame_digest = _file_digest(os.path.join(self.directory, name))
+                with self.lock:
+                    if self.files.get(name) is same_size[name]:
+                        same_size[name]["digest"] = frame_digest
+
+    def _record_source(self, path, stat, name, digest) -> None:
+        self.sources[os.path.abspath(path)] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "name": name,
+            "digest": digest,
+        }
+
+    def save(self) -> None:
+        with self.lock:
+            manifest = {"files": self.files, "sources": self.sources}
+            _write_atomically(self.manifest_path, json.dumps(manifest).encode("utf-8"))
+
+
+def _find_source_frames(source_dir: str, exclude_dir: str) -> list[str]:
+    """
+    Returns the FITS frames under source_dir, skipping Seestar's stacked
+    images and anything inside exclude_dir.
+    """
+    exclude_dir = os.path.realpath(exclude_dir)
+    frames = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(
+            d
+            for d in dirs
+            if os.path.realpath(os.path.join(root, d)) != exclude_dir
+            and not d.startswith(".")
+        )
+        for name in sorted(files):
+            if name.lower().endswith(FITS_EXTENSIONS) and not name.lower().startswith(
+                "stacked"
+            ):
+                frames.append(os.path.join(root, name))
+    return frames
+
+
+def _summarize_ingestion(frame_count: int, results: list[tuple]) -> dict:
+    """Tallies the per-frame (path, lights_dir, outcome, size) ingestion results."""
+    summary = {
+        "frames": frame_count,
+        "ingested": 0,
+        "duplicates": 0,
+        "bytes": 0,
+        "methods": {},
+        "targets": {},
+        "errors": [],
+    }
+    for path, lights_dir, outcome, size in results:
+        if lights_dir is None:
+            summary["errors"].append(f"{path}: {outcome[len('error: '):]}")
+        elif outcome == "duplicate":
+            summary["duplicates"] += 1
+        else:
+            summary["ingested"] += 1
+            summary["bytes"] += size
+            summary["methods"][outcome] = summary["methods"].get(outcome, 0) + 1
+            summary["targets"][lights_dir] = summary["targets"].get(lights_dir, 0) + 1
+    return summary
+
+
+def _ingest_workers(workers: int) -> int:
+    """Validates a requested worker count, capping it at INGEST_MAX_WORKERS."""
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+    return min(workers, INGEST_MAX_WORKERS)
+
+
+@_STAGE_DURATION.time(stage="ingest")
+def _ingest_seestar_frames(
+    source_dir: str,
+    destination_dir: str,
+    sort_by_target: bool = True,
+    workers: int = INGEST_WORKERS,
+) -> dict:
+    """
+    Internal function ingesting new FITS frames from a Seestar export.
+
+    With sort_by_target, each frame goes to
+    ``<destination_dir>/<OBJECT>/lights`` (from a header-only read);
+    otherwise destination_dir is the project and frames go to its lights/.
+    Frames already present with the same size and hash are skipped. Files
+    are processed by a pool of at most INGEST_MAX_WORKERS worker threads.
+    """
+    workers = _ingest_workers(workers)
+    if not os.path.isdir(source_dir):
+        raise FileNotFoundError(f"Source directory '{source_dir}' does not exist")
+    os.makedirs(destination_dir, exist_ok=True)
+    indexes: dict[str, _LightsIndex] = {}
+    indexes_lock = threading.Lock()
+
+    def lights_index(path: str) -> _LightsIndex:
+        if sort_by_target:
+            header, _ = _read_fits_header(path)
+            project_dir = os.path.join(
+                destination_dir, _target_dir_name(header.get("OBJECT"))
+            )
+        else:
+            project_dir = destination_dir
+        lights_dir = os.path.join(project_dir, "lights")
+        with indexes_lock:
+            if lights_dir not in indexes:
+                os.makedirs(lights_dir, exist_ok=True)
+                indexes[lights_dir] = _LightsIndex(lights_dir)
+            return indexes[lights_dir]
+
+    def ingest(path: str) -> tuple[str, str | None, str, int]:
+        try:
+            index = lights_index(path)
+            stat = os.stat(path)
+            if index.is_ingested(path, stat):
+                return path, index.directory, "duplicate", 0
+            staged = os.path.join(index.directory, f".tmp-{uuid.uuid4().hex}")
+            try:
+                method, digest = _clone_file(path, staged)
+                name = index.add(path, stat, staged, digest)
+            finally:
+                if os.path.lexists(staged):
+                    os.remove(staged)
+            if name is None:
+                return path, index.directory, "duplicate", 0
+            return path, index.directory, method, stat.st_size
+        except (OSError, ValueError) as e:
+            return path, None, f"error: {e}", 0
+
+    frames = _find_source_frames(source_dir, destination_dir)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(ingest, frames))
+    for index in indexes.values():
+        index.save()
+
+    summary = _summarize_ingestion(len(frames), results)
+    _BYTES_PROCESSED.inc(summary["bytes"], operation="ingest")
+    return summary
+
+
+@mcp.tool
+async def ingest_seestar_frames(
+    source_dir: str,
+    destination_dir: str,
+    sort_by_target: bool = True,
+    workers: int = INGEST_WORKERS,
+    ctx: Context = None,
+) -> str:
+    """
+    Copies new FITS frames from a Seestar export (e.g. the telescope's USB/SMB share)
+    into project lights/ folders. Frames already ingested are skipped by size and
+    content hash, and frames are reflinked or hardlinked instead of copied when the
+    source and destination share a filesystem, so re-running costs only the new data.
+
+    :param source_dir: folder of the Seestar export; searched recursively
+    :param destination_dir: with sort_by_target, the folder holding one project per
+        target; otherwise the project root itself
+    :param sort_by_target: sort frames into '<destination_dir>/<OBJECT>/lights' using
+        each frame's OBJECT header
+    :param workers: number of files processed in parallel (at most 32)
+    :returns: summary of the ingestion
+    """
+    if ctx:
+        await ctx.info(f"Ingesting frames from {source_dir} into {destination_dir}")
+    summary = await asyncio.to_thread(
+        _ingest_seestar_frames, source_dir, destination_dir, sort_by_target, workers
+    )
+
+    report = [
+        f"📥 Ingested {summary['ingested']} of {summary['frames']} frames "
+        f"({summary['bytes'] / 1024**2:.1f} MiB), "
+        f"skipped {summary['duplicates']} already present"
+    ]
+    if summary["methods"]:
+        methods = ", ".join(
+            f"{n} by {m}" for m, n in sorted(summary["methods"].items())
+        )
+        report.append(f"   {methods}")
+    for lights_dir, count in sorted(summary["targets"].items()):
+        report.append(f"✅ {lights_dir}: {count} new frames")
+    for error in summary["errors"]:
+        report.append(f"❌ {error}")
+    if ctx and summary["errors"]:
+        await ctx.warning(f"{len(summary['errors'])} frames could not be ingested")
+    return "\n".join(report)
+
+
+@mcp.resource("metrics://siril-mcp", mime_type="text/plain")
+def server_metrics() -> str:
+    """
+    Server metrics in the Prometheus text format: tool call latency, job
+    queue depth, running Siril processes, stage durations, cache hits and
+    bytes processed.
+    """
+    return METRICS.render()
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """Serves the metrics to Prometheus when running over http/sse."""
+    return PlainTextResponse(METRICS.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def _start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serves the metrics on http://host:port/metrics from a background thread,
+    for the stdio transport which has no HTTP server of its own.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            # stdout belongs to the stdio transport
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv: list[str] | None = None):
     """Entry point for the siril-mcp command."""
-    mcp.run()
+    parser = argparse.ArgumentParser(
+        prog="siril-mcp",
+        description="Model Context Protocol server for Siril astronomical image "
+        "processing.",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["stdio", "http", "sse"],
+        default="stdio",
+        help="stdio (default) serves a single client; http (streamable HTTP) and "
+        "sse serve many clients from one process, sharing its jobs and caches",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on for http/sse; the server has no authentication, "
+        "so only expose it behind an authenticating proxy or on a trusted network",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="port to listen on for http/sse"
+    )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        help="maximum number of Siril jobs running at once "
+        "(default: $SIRIL_MCP_MAX_JOBS or 1)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="also serve Prometheus metrics on http://<host>:<port>/metrics; "
+        "http/sse transports always serve them on /metrics",
+    )
+    args = parser.parse_args(argv)
+    if args.max_jobs is not None:
+        if args.max_jobs < 1:
+            parser.error("--max-jobs must be at least 1")
+        _job_manager.set_max_concurrent_jobs(args.max_jobs)
+    if args.metrics_port is not None:
+        _start_metrics_server(args.host, args.metrics_port)
+
+    if args.transport == "stdio":
+        mcp.run()
+    else:
+        mcp.run(
+            transport="streamable-http" if args.transport == "http" else "sse",
+            host=args.host,
+            port=args.port,
+        )
 
 
 if __name__ == "__main__":
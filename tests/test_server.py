@@ -1,7 +1,11 @@
 """Tests for the Siril MCP server."""
 
+import json
 import os
+import shutil
 import tempfile
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -210,19 +214,990 @@ def test_find_siril_binary_invalid_env_var(mock_env_get):
 
 def test_project_structure_validation():
     """Test project structure validation logic."""
-    from siril_mcp.server import _process_seestar_mosaic
+    from fastmcp.exceptions import ToolError
 
     with tempfile.TemporaryDirectory() as temp_dir:
         # Test missing lights directory
-        with pytest.raises(FileNotFoundError, match="No 'lights' folder found"):
-            _process_seestar_mosaic(temp_dir, "broadband")
+        with pytest.raises(ToolError, match="No 'lights' folder found"):
+            _call_tool("process_seestar_mosaic", {"project_dir": temp_dir})
 
         # Test invalid filter type
         lights_dir = os.path.join(temp_dir, "lights")
         os.makedirs(lights_dir)
 
-        with pytest.raises(ValueError, match="Unknown filter_type"):
-            _process_seestar_mosaic(temp_dir, "invalid_filter")
+        with pytest.raises(ToolError, match="invalid_filter"):
+            _call_tool(
+                "process_seestar_mosaic",
+                {"project_dir": temp_dir, "filter_type": "invalid_filter"},
+            )
+
+
+def _call_tool(name, arguments):
+    """Calls a tool through an in-process MCP client and returns its text."""
+    import asyncio
+
+    from fastmcp import Client
+
+    from siril_mcp.server import mcp
+
+    async def call():
+        async with Client(mcp) as client:
+            result = await client.call_tool(name, arguments)
+        return result.content[0].text
+
+    return asyncio.run(call())
+
+
+def _latest_job():
+    """Returns the most recently registered Siril job."""
+    from siril_mcp.server import _job_manager
+
+    return _job_manager.jobs()[-1]
+
+
+def _write_fake_siril(directory, body):
+    """Writes an executable shell script standing in for the Siril binary."""
+    path = os.path.join(directory, "fake-siril")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#!/bin/sh\n" + body)
+    os.chmod(path, 0o755)
+    return path
+
+
+def test_job_log_rotation_and_tail():
+    """Test that job logs rotate on disk and keep a bounded in-memory tail."""
+    from siril_mcp.server import JobLog, _job_log_files, _tail_job_log
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        job_log = JobLog(
+            "job-1", log_dir=temp_dir, max_bytes=200, backup_count=2, tail_lines=5
+        )
+        for i in range(100):
+            job_log.write(f"line {i}\n")
+        job_log.close()
+
+        assert job_log.tail() == [f"line {i}" for i in range(95, 100)]
+        files = _job_log_files("job-1", temp_dir)
+        assert [os.path.basename(f) for f in files] == [
+            "job-1.log.2",
+            "job-1.log.1",
+            "job-1.log",
+        ]
+        assert all(os.path.getsize(f) <= 200 for f in files)
+
+        # The tail spans rotated files
+        assert _tail_job_log("job-1", 30, temp_dir) == [
+            f"line {i}" for i in range(70, 100)
+        ]
+
+
+def test_job_log_retention():
+    """Test that creating a job log deletes the oldest logs beyond retention."""
+    from siril_mcp.server import JobLog
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i in range(4):
+            job_log = JobLog(f"job-{i}", log_dir=temp_dir, max_bytes=20, retention=3)
+            for line in range(5):
+                job_log.write(f"line {line}")
+            job_log.close()
+            os.utime(job_log.path, (1000 + i, 1000 + i))
+
+        remaining = sorted(os.listdir(temp_dir))
+        assert not any(name.startswith("job-0.") for name in remaining)
+        assert "job-1.log" in remaining and "job-3.log" in remaining
+        assert "job-1.log.1" in remaining
+
+
+def test_search_job_log():
+    """Test searching a job log returns the most recent matches."""
+    from siril_mcp.server import JobLog, _search_job_log
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        job_log = JobLog("job-2", log_dir=temp_dir)
+        for i in range(20):
+            job_log.write(f"frame {i}: {'ERROR' if i % 5 == 0 else 'ok'}")
+        job_log.close()
+
+        matches = _search_job_log("job-2", "error", max_matches=2, log_dir=temp_dir)
+        assert matches == [(11, "frame 10: ERROR"), (16, "frame 15: ERROR")]
+        assert (
+            _search_job_log("job-2", "error", ignore_case=False, log_dir=temp_dir) == []
+        )
+
+        with pytest.raises(ValueError, match="Invalid search pattern"):
+            _search_job_log("job-2", "(", log_dir=temp_dir)
+        with pytest.raises(ValueError, match="Invalid job_id"):
+            _search_job_log("../job-2", "ok", log_dir=temp_dir)
+        with pytest.raises(FileNotFoundError, match="No log found"):
+            _search_job_log("missing", "ok", log_dir=temp_dir)
+
+
+def test_process_seestar_mosaic_failure_reports_log_tail():
+    """Test that a failed Siril run reports only the tail of its streamed log."""
+    from fastmcp.exceptions import ToolError
+
+    from siril_mcp.server import JOB_LOG_ERROR_LINES
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "lights"))
+        siril = _write_fake_siril(
+            temp_dir,
+            'i=0; while [ $i -lt 500 ]; do echo "output $i"; i=$((i+1)); done\n'
+            'echo "fatal error" >&2\nexit 3\n',
+        )
+
+        with (
+            patch.dict(os.environ, {"SIRIL_MCP_CACHE_DIR": temp_dir}),
+            patch("siril_mcp.server._find_siril_binary", return_value=siril),
+        ):
+            with pytest.raises(ToolError, match="exit code 3") as exc_info:
+                _call_tool("process_seestar_mosaic", {"project_dir": temp_dir})
+
+        job = _latest_job()
+        message = str(exc_info.value)
+        assert "fatal error" in message
+        assert "output 499" in message
+        assert "output 0\n" not in message
+        assert message.count("output ") == JOB_LOG_ERROR_LINES - 1
+
+        log_path = os.path.join(temp_dir, "logs", f"{job.job_id}.log")
+        with open(log_path, encoding="utf-8") as f:
+            assert len(f.readlines()) == 501
+        assert job.status == "failed"
+
+
+def _pid_alive(pid):
+    """Returns whether a process exists and is not a zombie."""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses POSIX process groups")
+def test_process_seestar_mosaic_timeout_kills_process_tree():
+    """Test that a timed out job kills Siril's children and removes intermediates."""
+    from fastmcp.exceptions import ToolError
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        project_dir = os.path.join(temp_dir, "project")
+        os.makedirs(os.path.join(project_dir, "lights"))
+        # The script ignores SIGTERM, so the group has to be killed
+        siril = _write_fake_siril(
+            temp_dir,
+            "trap '' TERM\n"
+            "mkdir -p process && echo partial > process/light_00001.fit\n"
+            "echo partial > result_og.fit\n"
+            "mkdir result_og_tiles && echo other > notes.txt\n"
+            "sleep 60 &\necho $! > ../child.pid\nwait\n",
+        )
+
+        with (
+            patch.dict(os.environ, {"SIRIL_MCP_CACHE_DIR": temp_dir}),
+            patch("siril_mcp.server._find_siril_binary", return_value=siril),
+            patch("siril_mcp.server.SIRIL_TERMINATE_GRACE_SECONDS", 0.2),
+        ):
+            with pytest.raises(ToolError, match="timed out after 0.5s"):
+                _call_tool(
+                    "process_seestar_mosaic",
+                    {"project_dir": project_dir, "timeout_seconds": 0.5},
+                )
+
+        assert _latest_job().status == "timed_out"
+        assert not os.path.exists(os.path.join(project_dir, "process"))
+        assert not os.path.exists(os.path.join(project_dir, "result_og.fit"))
+        assert os.path.isdir(os.path.join(project_dir, "lights"))
+        # Only Siril's own outputs are cleaned up
+        assert os.path.isdir(os.path.join(project_dir, "result_og_tiles"))
+        assert os.path.isfile(os.path.join(project_dir, "notes.txt"))
+        with open(os.path.join(temp_dir, "child.pid"), encoding="utf-8") as f:
+            child_pid = int(f.read())
+        for _ in range(50):
+            if not _pid_alive(child_pid):
+                break
+            time.sleep(0.1)
+        assert not _pid_alive(child_pid)
+
+
+def test_parse_job_timeout():
+    """Test that job timeouts of 0 or less mean no limit and junk is rejected."""
+    from siril_mcp.server import _parse_job_timeout
+
+    assert _parse_job_timeout("90") == 90.0
+    assert _parse_job_timeout(2.5) == 2.5
+    assert _parse_job_timeout("0") is None
+    assert _parse_job_timeout(-1) is None
+    assert _parse_job_timeout("") is None
+    assert _parse_job_timeout(None) is None
+    for value in ("soon", "nan"):
+        with pytest.raises(ValueError, match="Invalid job timeout"):
+            _parse_job_timeout(value)
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses POSIX process groups")
+def test_cancel_siril_job():
+    """Test cancelling a running job with the cancel_siril_job tool."""
+    import asyncio
+
+    from fastmcp import Client
+    from fastmcp.exceptions import ToolError
+
+    from siril_mcp.server import mcp
+
+    async def run_and_cancel(project_dir):
+        async with Client(mcp) as client:
+            task = asyncio.create_task(
+                client.call_tool(
+                    "process_seestar_mosaic",
+                    {"project_dir": project_dir, "filter_type": "narrowband"},
+                )
+            )
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                job = _latest_job()
+                if job.project_dir == project_dir and job.status == "running":
+                    break
+            result = await client.call_tool("cancel_siril_job", {"job_id": job.job_id})
+            assert "Cancellation requested" in result.content[0].text
+            with pytest.raises(ToolError, match="was cancelled"):
+                await asyncio.wait_for(task, 10)
+        return job
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "lights"))
+        siril = _write_fake_siril(temp_dir, "echo started\nsleep 60\n")
+        with (
+            patch.dict(os.environ, {"SIRIL_MCP_CACHE_DIR": temp_dir}),
+            patch("siril_mcp.server._find_siril_binary", return_value=siril),
+        ):
+            job = asyncio.run(run_and_cancel(temp_dir))
+
+        assert job.status == "cancelled"
+        assert job.cancel() is False
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses POSIX process groups")
+def test_client_cancellation_stops_siril():
+    """Test that a cancelled tool call stops Siril and frees the job's slot."""
+    import asyncio
+
+    from siril_mcp.server import _job_manager, process_seestar_mosaic
+
+    async def run_and_cancel(project_dir):
+        task = asyncio.create_task(process_seestar_mosaic(project_dir))
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            job = _latest_job()
+            if job.project_dir == project_dir and job.status == "running":
+                break
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return job
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "lights"))
+        siril = _write_fake_siril(temp_dir, "sleep 60\n")
+        with (
+            patch.dict(os.environ, {"SIRIL_MCP_CACHE_DIR": temp_dir}),
+            patch("siril_mcp.server._find_siril_binary", return_value=siril),
+        ):
+            job = asyncio.run(run_and_cancel(temp_dir))
+
+        for _ in range(50):
+            if job.finished:
+                break
+            time.sleep(0.1)
+        assert job.status == "cancelled"
+        assert _job_manager.running_count == 0
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses a shell script as Siril")
+def test_cancel_after_siril_exits_keeps_success():
+    """Test that a cancel landing after Siril exits 0 doesn't discard the run."""
+    from siril_mcp import server
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "lights"))
+        siril = _write_fake_siril(temp_dir, "echo done > result_og.fit\n")
+        run_siril_script = server._run_siril_script
+
+        def run_then_time_out(siril_binary, ssf_name, job_log, cwd, job, timeout):
+            returncode = run_siril_script(
+                siril_binary, ssf_name, job_log, cwd, job, timeout
+            )
+            job.cancel("timeout")
+            return returncode
+
+        with (
+            patch.dict(os.environ, {"SIRIL_MCP_CACHE_DIR": temp_dir}),
+            patch("siril_mcp.server._find_siril_binary", return_value=siril),
+            patch("siril_mcp.server._run_siril_script", run_then_time_out),
+        ):
+            _call_tool(
+                "process_seestar_mosaic",
+                {"project_dir": temp_dir, "timeout_seconds": 60},
+            )
+
+        job = _latest_job()
+        assert job.status == "succeeded"
+        assert not job.signalled
+        assert os.path.isfile(os.path.join(temp_dir, "result_og.fit"))
+
+
+def _write_fits(path, data, bitpix=-32, **keywords):
+    """Writes a minimal single-HDU FITS file for tests."""
+    np = pytest.importorskip("numpy")
+
+    def card(key, value):
+        if isinstance(value, bool):
+            value = "T" if value else "F"
+        elif isinstance(value, str):
+            value = "'" + value.replace("'", "''").ljust(8) + "'"
+            return f"{key:<8}= {value:<70}"
+        return f"{key:<8}= {value:>20}".ljust(80)
+
+    cards = [card("SIMPLE", True), card("BITPIX", bitpix), card("NAXIS", data.ndim)]
+    for axis, length in enumerate(reversed(data.shape), start=1):
+        cards.append(card(f"NAXIS{axis}", length))
+    cards += [card(key, value) for key, value in keywords.items()]
+    cards.append("END".ljust(80))
+    header = "".join(cards).encode("ascii")
+    header += b" " * (-len(header) % 2880)
+    dtype = {16: ">i2", -32: ">f4"}[bitpix]
+    payload = np.ascontiguousarray(data, dtype=dtype).tobytes()
+    payload += b"\0" * (-len(payload) % 2880)
+    with open(path, "wb") as f:
+        f.write(header + payload)
+
+
+def _synthetic_mosaic(np, stars):
+    """Returns a noisy 3-channel image with Gaussian stars and zero padding."""
+    rng = np.random.default_rng(42)
+    image = rng.normal(0.1, 0.01, size=(3, 300, 400)).astype(np.float32)
+    yy, xx = np.mgrid[0:300, 0:400]
+    for y, x in stars:
+        image += 0.5 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 4.0)
+    image[:, :, :20] = 0
+    return image
+
+
+def test_read_fits_header():
+    """Test that FITS headers are parsed without reading the data."""
+    np = pytest.importorskip("numpy")
+    from siril_mcp.server import _read_fits_header
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "frame.fit")
+        data = np.zeros((4, 5), dtype=np.int16)
+        _write_fits(path, data, bitpix=16, BZERO=32768, OBJECT="M 31 'And'")
+
+        header, offset = _read_fits_header(path)
+        assert offset == 2880
+        assert header["SIMPLE"] is True
+        assert header["NAXIS1"] == 5 and header["NAXIS2"] == 4
+        assert header["BZERO"] == 32768
+        assert header["OBJECT"] == "M 31 'And'"
+
+        with open(path, "wb") as f:
+            f.write(b"not a fits file")
+        with pytest.raises(ValueError, match="is not a FITS file"):
+            _read_fits_header(path)
+
+
+def test_compute_fits_statistics():
+    """Test tiled statistics on a synthetic mosaic."""
+    np = pytest.importorskip("numpy")
+    from siril_mcp.server import _compute_fits_statistics
+
+    # Two stars sit on tile boundaries and must still be counted once
+    stars = [(50, 60), (128, 128), (200, 255), (250, 350), (64, 300), (150, 180)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "M31_og.fit")
+        _write_fits(path, _synthetic_mosaic(np, stars), OBJECT="M31")
+
+        stats = _compute_fits_statistics(path, tile_size=128, bins=16)
+
+    assert (stats["width"], stats["height"], stats["channels"]) == (400, 300, 3)
+    assert stats["object"] == "M31"
+    assert stats["stars"] == len(stars)
+    for channel in stats["channel_stats"]:
+        assert channel["background"] == pytest.approx(0.1, abs=0.002)
+        assert channel["noise"] == pytest.approx(0.01, rel=0.1)
+        assert channel["valid_pixels"] == 300 * 380
+        assert sum(channel["histogram"]) == 300 * 380
+        assert channel["max"] == pytest.approx(0.6, abs=0.05)
+        assert channel["snr"] > 3
+
+
+def test_star_count_ignores_bright_extended_regions():
+    """Test that noise over a nebula-like region or gradient isn't counted as stars."""
+    np = pytest.importorskip("numpy")
+    from siril_mcp.server import _compute_fits_statistics
+
+    rng = np.random.default_rng(7)
+    yy, xx = np.mgrid[0:600, 0:800]
+    image = rng.normal(0.1, 0.01, size=(600, 800)).astype(np.float32)
+    # A bright region over 3/8 of the frame, a gradient and a galaxy core
+    image[:, :300] += 0.1
+    image += (0.05 * xx / 800).astype(np.float32)
+    image += (0.3 * np.exp(-((yy - 300) ** 2 + (xx - 550) ** 2) / 7200.0)).astype(
+        np.float32
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "nebula_og.fit")
+        _write_fits(path, image)
+        starless = _compute_fits_statistics(path)["stars"]
+
+        # Stars on top of the bright region are still found
+        for y, x in ((150, 120), (450, 220), (300, 700)):
+            image += (0.5 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 4.0)).astype(
+                np.float32
+            )
+        _write_fits(path, image)
+        with_stars = _compute_fits_statistics(path)["stars"]
+
+    assert starless <= 2
+    assert with_stars - starless == 3
+
+
+def test_find_mosaic_outputs():
+    """Test that the newest saved mosaic is picked from a project dir."""
+    from siril_mcp.server import _resolve_mosaic_path
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with pytest.raises(FileNotFoundError, match="No _SPCC or _og mosaic"):
+            _resolve_mosaic_path(temp_dir)
+
+        for i, name in enumerate(["M31_og.fit", "M31_SPCC.fit", "notes.txt"]):
+            path = os.path.join(temp_dir, name)
+            open(path, "w").close()
+            os.utime(path, (1000 + i, 1000 + i))
+
+        assert _resolve_mosaic_path(temp_dir) == os.path.join(temp_dir, "M31_SPCC.fit")
+
+
+def _read_png(path):
+    """Decodes an unfiltered 8-bit PNG written by the preview generator."""
+    np = pytest.importorskip("numpy")
+    import struct
+    import zlib
+
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data.startswith(b"\x89PNG\r\n\x1a\n")
+    width, height, _, color_type = struct.unpack(">IIBB", data[16:26])
+    idat_length = struct.unpack(">I", data[33:37])[0]
+    raw = zlib.decompress(data[41 : 41 + idat_length])
+    channels = 3 if color_type == 2 else 1
+    rows = np.frombuffer(raw, dtype=np.uint8).reshape(height, 1 + width * channels)
+    return rows[:, 1:].reshape(height, width, channels)
+
+
+def test_generate_tile_pyramid():
+    """Test the streamed preview pyramid layout, sizes and orientation."""
+    np = pytest.importorskip("numpy")
+    from siril_mcp.server import _generate_tile_pyramid
+
+    image = _synthetic_mosaic(np, [(150, 200)])
+    # A bright block at the first FITS rows is the bottom of the picture
+    image[:, :10, 100:110] = 1.0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "M31_SPCC.fit")
+        _write_fits(path, image)
+
+        manifest = _generate_tile_pyramid(path, tile_size=64, thumbnail_size=64)
+
+        output_dir = os.path.join(temp_dir, "M31_SPCC_tiles")
+        assert manifest["output_dir"] == output_dir
+        assert [(lv["width"], lv["height"]) for lv in manifest["levels"]] == [
+            (50, 38),
+            (100, 75),
+            (200, 150),
+            (400, 300),
+        ]
+        with open(os.path.join(output_dir, "pyramid.json"), encoding="utf-8") as f:
+            assert json.load(f)["levels"][3]["columns"] == 7
+
+        assert len(os.listdir(os.path.join(output_dir, "3"))) == 7 * 5
+        assert _read_png(os.path.join(output_dir, "3", "6_4.png")).shape == (44, 16, 3)
+        thumbnail = _read_png(os.path.join(output_dir, "thumbnail.png"))
+        assert thumbnail.shape == (38, 50, 3)
+
+        # Background is stretched towards the autostretch target, not left black
+        full = _read_png(os.path.join(output_dir, "3", "2_0.png"))
+        assert 30 < np.median(full) < 100
+        bottom = _read_png(os.path.join(output_dir, "3", "1_4.png"))
+        assert bottom[-10:, 100 - 64 : 110 - 64].min() == 255
+        # Zero padding on the left stays black
+        left = _read_png(os.path.join(output_dir, "3", "0_0.png"))
+        assert left[:, :20].max() == 0
+
+
+class _ScriptServer:
+    """Local stand-in for the script repository, honouring If-None-Match."""
+
+    def __init__(self, scripts):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.scripts = scripts
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                name = self.path.lstrip("/")
+                server.requests.append((name, self.headers.get("If-None-Match")))
+                if name not in server.scripts:
+                    self.send_error(404)
+                    return
+                body = server.scripts[name].encode("utf-8")
+                etag = f'"{hash(body)}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def test_download_ssf_scripts_uses_conditional_cache():
+    """Test that cached scripts are revalidated with conditional requests."""
+    import asyncio
+
+    from siril_mcp.server import SSF_SCRIPT_CONTENTS, _download_ssf_scripts
+
+    broadband = SSF_SCRIPTS["broadband"]
+    narrowband = SSF_SCRIPTS["narrowband"]
+    server = _ScriptServer({broadband: "# remote broadband\n"})
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_dir = os.path.join(temp_dir, "cache")
+            projects = [os.path.join(temp_dir, name) for name in ("m31", "m42")]
+            for project in projects:
+                os.makedirs(project)
+
+            def download(project, max_age=300):
+                return asyncio.run(
+                    _download_ssf_scripts(project, server.url, max_age, cache_dir)
+                )
+
+            statuses = download(projects[0])
+            assert statuses[broadband] == "downloaded"
+            assert statuses[narrowband].startswith("fallback")
+            with open(os.path.join(projects[0], narrowband), encoding="utf-8") as f:
+                assert f.read() == SSF_SCRIPT_CONTENTS["narrowband"]
+            assert len(server.requests) == 2
+
+            # A recently checked script costs no request at all
+            assert download(projects[1])[broadband] == "fresh"
+            assert len(server.requests) == 3
+            # Projects get writable copies of the read-only cache
+            cache_mode = os.stat(os.path.join(cache_dir, broadband)).st_mode
+            assert cache_mode & 0o777 == 0o444
+            project_script = os.path.join(projects[1], broadband)
+            assert not os.path.samefile(
+                os.path.join(projects[0], broadband), project_script
+            )
+            assert os.stat(project_script).st_mode & 0o200
+            with open(project_script, "a", encoding="utf-8") as f:
+                f.write("# local edit\n")
+            with open(os.path.join(projects[0], broadband), encoding="utf-8") as f:
+                assert f.read() == "# remote broadband\n"
+
+            # An expired one costs a single conditional request
+            assert download(projects[1], max_age=0)[broadband] == "not modified"
+            broadband_requests = [r for r in server.requests if r[0] == broadband]
+            assert len(broadband_requests) == 2
+            assert broadband_requests[-1][1] is not None
+
+            # A changed script replaces the cache without touching other projects
+            server.scripts[broadband] = "# updated broadband\n"
+            assert download(projects[1], max_age=0)[broadband] == "downloaded"
+            with open(os.path.join(projects[1], broadband), encoding="utf-8") as f:
+                assert f.read() == "# updated broadband\n"
+            with open(os.path.join(projects[0], broadband), encoding="utf-8") as f:
+                assert f.read() == "# remote broadband\n"
+
+            # A cache edited behind our back is downloaded again, not trusted
+            cache_path = os.path.join(cache_dir, broadband)
+            os.chmod(cache_path, 0o644)
+            with open(cache_path, "a", encoding="utf-8") as f:
+                f.write("# tampered\n")
+            assert download(projects[1])[broadband] == "downloaded"
+            with open(os.path.join(projects[1], broadband), encoding="utf-8") as f:
+                assert f.read() == "# updated broadband\n"
+    finally:
+        server.close()
+
+
+def test_job_manager_queues_jobs():
+    """Test that the job manager limits concurrency and serializes projects."""
+    import asyncio
+
+    from siril_mcp.server import JobManager, SirilJob
+
+    manager = JobManager(max_concurrent_jobs=2)
+    first = manager.register(SirilJob("/projects/m31", "broadband"))
+    same_project = manager.register(SirilJob("/projects/m31", "narrowband"))
+    other_project = manager.register(SirilJob("/projects/m42", "broadband"))
+    queued = manager.register(SirilJob("/projects/m81", "broadband"))
+
+    async def main():
+        assert await manager.acquire(first) is True
+        waiting = asyncio.create_task(manager.acquire(same_project))
+        await asyncio.sleep(0.1)
+        # A different project can still use the second slot
+        assert await manager.acquire(other_project) is True
+        assert manager.queue_depth == 1 and manager.running_count == 2
+        assert not waiting.done()
+
+        manager.release(first)
+        assert await asyncio.wait_for(waiting, 5) is True
+
+        # A queued job that is cancelled gives up its place without a slot
+        waiting = asyncio.create_task(manager.acquire(queued))
+        await asyncio.sleep(0.1)
+        assert queued.cancel() is True
+        assert await asyncio.wait_for(waiting, 5) is False
+
+    asyncio.run(main())
+    assert manager.queue_depth == 0 and manager.running_count == 2
+    assert [job.job_id for job in manager.jobs()][:2] == [
+        first.job_id,
+        same_project.job_id,
+    ]
+
+
+def test_job_manager_queue_keeps_threads_free():
+    """Test that jobs queued on the event loop don't hold executor threads."""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from siril_mcp.server import JobManager, SirilJob
+
+    manager = JobManager(max_concurrent_jobs=1)
+    first = manager.register(SirilJob("/projects/m31", "broadband"))
+    queued = [
+        manager.register(SirilJob(f"/projects/m{i}", "broadband")) for i in range(3)
+    ]
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(1))
+        assert await manager.acquire(first) is True
+        tasks = [asyncio.create_task(manager.acquire(job)) for job in queued]
+        await asyncio.sleep(0.1)
+        assert manager.queue_depth == 3
+        # The only worker thread is still free for other tools
+        assert await asyncio.wait_for(asyncio.to_thread(lambda: "ok"), 1) == "ok"
+
+        # Releasing a slot wakes the next job without waiting for a poll
+        started = time.monotonic()
+        threading.Timer(0.05, manager.release, args=(first,)).start()
+        assert await asyncio.wait_for(tasks[0], 5) is True
+        assert time.monotonic() - started < 1
+
+        assert queued[1].cancel() is True
+        assert await asyncio.wait_for(tasks[1], 5) is False
+        tasks[2].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tasks[2]
+
+    with patch("siril_mcp.server.JOB_QUEUE_POLL_SECONDS", 2):
+        asyncio.run(main())
+    assert manager.queue_depth == 0 and manager.running_count == 1
+
+
+def test_cancel_before_worker_starts_frees_slot():
+    """Test that a job cancelled while waiting for a worker thread frees its slot."""
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from siril_mcp.server import _job_manager, process_seestar_mosaic
+
+    async def main(project_dir):
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(1))
+        blocker = threading.Event()
+        busy = asyncio.ensure_future(asyncio.to_thread(blocker.wait))
+        await asyncio.sleep(0.05)
+        task = asyncio.create_task(process_seestar_mosaic(project_dir))
+        for _ in range(50):
+            if _job_manager.running_count:
+                break
+            await asyncio.sleep(0.02)
+        job = _job_manager.jobs()[-1]
+        assert job.project_dir == project_dir and job.status == "queued"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        blocker.set()
+        await busy
+        return job
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.makedirs(os.path.join(temp_dir, "lights"))
+        with patch(
+            "siril_mcp.server._run_queued_mosaic_job", side_effect=AssertionError
+        ):
+            job = asyncio.run(main(temp_dir))
+
+    assert job.status == "cancelled"
+    assert _job_manager.running_count == 0
+
+
+@pytest.mark.parametrize(
+    "argv, expected",
+    [
+        ([], {}),
+        (
+            ["--transport", "http", "--host", "0.0.0.0", "--port", "9000"],
+            {"transport": "streamable-http", "host": "0.0.0.0", "port": 9000},
+        ),
+        (
+            ["--transport", "sse"],
+            {"transport": "sse", "host": "127.0.0.1", "port": 8000},
+        ),
+    ],
+)
+def test_main_transport(argv, expected):
+    """Test that the CLI picks the transport the server runs on."""
+    from siril_mcp.server import _job_manager, main
+
+    with (
+        patch("siril_mcp.server.mcp.run") as mock_run,
+        patch.object(_job_manager, "max_concurrent_jobs", 1),
+    ):
+        main(argv + ["--max-jobs", "3"])
+        assert _job_manager.max_concurrent_jobs == 3
+    mock_run.assert_called_once_with(**expected)
+
+
+def test_metrics_registry_render():
+    """Test the Prometheus text format of counters, gauges and histograms."""
+    from siril_mcp.server import Counter, Gauge, Histogram, MetricsRegistry
+
+    registry = MetricsRegistry()
+    calls = registry.register(Counter("calls_total", "Calls.", ("tool",)))
+    registry.register(Gauge("queue_depth", "Queue.", function=lambda: 3))
+    latency = registry.register(
+        Histogram("latency_seconds", "Latency.", buckets=(1, 5))
+    )
+
+    calls.inc(tool='say "hi"')
+    calls.inc(2, tool='say "hi"')
+    latency.observe(0.5)
+    latency.observe(2)
+    with pytest.raises(ValueError, match="expects labels"):
+        calls.inc(stage="x")
+
+    assert registry.render() == (
+        "# HELP calls_total Calls.\n"
+        "# TYPE calls_total counter\n"
+        'calls_total{tool="say \\"hi\\""} 3\n'
+        "# HELP queue_depth Queue.\n"
+        "# TYPE queue_depth gauge\n"
+        "queue_depth 3\n"
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="1"} 1\n'
+        'latency_seconds_bucket{le="5"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 2\n'
+        "latency_seconds_sum 2.5\n"
+        "latency_seconds_count 2\n"
+    )
+
+
+def test_tool_call_metrics():
+    """Test that tool calls are measured and exposed as an MCP resource."""
+    import asyncio
+
+    from fastmcp import Client
+
+    from siril_mcp.server import _TOOL_CALLS, _TOOL_DURATION, mcp
+
+    async def call_and_read_metrics(project_dir):
+        async with Client(mcp) as client:
+            await client.call_tool(
+                "check_project_structure", {"project_dir": project_dir}
+            )
+            with pytest.raises(Exception):
+                await client.call_tool("tail_job_log", {"job_id": "../missing"})
+            with pytest.raises(Exception):
+                await client.call_tool("no_such_tool_42", {})
+            contents = await client.read_resource("metrics://siril-mcp")
+        return contents[0].text
+
+    ok_before = _TOOL_CALLS.value(tool="check_project_structure", status="ok")
+    error_before = _TOOL_CALLS.value(tool="tail_job_log", status="error")
+    unknown_before = _TOOL_CALLS.value(tool="unknown", status="error")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        text = asyncio.run(call_and_read_metrics(temp_dir))
+
+    assert (
+        _TOOL_CALLS.value(tool="check_project_structure", status="ok") == ok_before + 1
+    )
+    assert _TOOL_CALLS.value(tool="tail_job_log", status="error") == error_before + 1
+    # Client-chosen names of missing tools don't create series of their own
+    assert _TOOL_CALLS.value(tool="unknown", status="error") == unknown_before + 1
+    assert "no_such_tool_42" not in text
+    assert _TOOL_DURATION.count(tool="check_project_structure") >= 1
+    assert (
+        'siril_mcp_tool_calls_total{tool="check_project_structure",status="ok"}' in text
+    )
+    assert "siril_mcp_job_queue_depth 0" in text
+    assert "siril_mcp_active_siril_processes 0" in text
+
+
+def test_ingest_seestar_frames_deduplicates():
+    """Test sorting frames by target and skipping frames already ingested."""
+    np = pytest.importorskip("numpy")
+    from siril_mcp.server import _file_digest, _ingest_seestar_frames
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        export = os.path.join(temp_dir, "export")
+        projects = os.path.join(temp_dir, "projects")
+        os.makedirs(os.path.join(export, "M 31_sub"))
+        os.makedirs(os.path.join(export, "M 42_sub"))
+        frames = {
+            "M 31_sub/Light_M 31_001.fit": ("M 31", 1),
+            "M 31_sub/Light_M 31_002.fit": ("M 31", 2),
+            "M 42_sub/Light_M 42_001.fit": ("M 42", 3),
+            # Same contents as the first frame under another name
+            "M 31_sub/copy/Light_M 31_001.fit": ("M 31", 1),
+            "Stacked_2_M 31.fit": ("M 31", 4),
+        }
+        for name, (target, value) in frames.items():
+            path = os.path.join(export, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_fits(path, np.full((8, 8), value, dtype=np.float32), OBJECT=target)
+        with open(os.path.join(export, "M 42_sub", "broken.fit"), "wb") as f:
+            f.write(b"garbage")
+
+        summary = _ingest_seestar_frames(export, projects, workers=3)
+
+        assert summary["frames"] == 5
+        assert summary["ingested"] == 3
+        assert summary["duplicates"] == 1
+        assert len(summary["errors"]) == 1 and "broken.fit" in summary["errors"][0]
+        assert set(summary["methods"]) <= {"reflink", "hardlink", "copy"}
+        m31_lights = os.path.join(projects, "M_31", "lights")
+        m42_lights = os.path.join(projects, "M_42", "lights")
+        assert sorted(f for f in os.listdir(m31_lights) if f.endswith(".fit")) == [
+            "Light_M 31_001.fit",
+            "Light_M 31_002.fit",
+        ]
+        assert sorted(os.listdir(m42_lights)) == [
+            ".siril-mcp-ingest.json",
+            "Light_M 42_001.fit",
+        ]
+
+        # Re-ingesting the unchanged export reads no frame contents at all
+        with patch(
+            "siril_mcp.server._file_digest", side_effect=_file_digest
+        ) as mock_digest:
+            summary = _ingest_seestar_frames(export, projects)
+        assert summary["ingested"] == 0
+        assert summary["duplicates"] == 4
+        mock_digest.assert_not_called()
+
+        # A new frame is ingested and a renamed duplicate is still detected
+        _write_fits(
+            os.path.join(export, "M 31_sub", "Light_M 31_003.fit"),
+            np.full((8, 8), 5, dtype=np.float32),
+            OBJECT="M 31",
+        )
+        shutil.copy(
+            os.path.join(export, "M 42_sub", "Light_M 42_001.fit"),
+            os.path.join(export, "M 42_sub", "Light_M 42_renamed.fit"),
+        )
+        with patch(
+            "siril_mcp.server._file_digest", side_effect=_file_digest
+        ) as mock_digest:
+            summary = _ingest_seestar_frames(export, projects)
+        assert summary["ingested"] == 1
+        assert summary["targets"] == {m31_lights: 1}
+        # Equal-size frames are hashed from their local copies, not the export
+        hashed = [call.args[0] for call in mock_digest.call_args_list]
+        assert hashed and all(path.startswith(projects) for path in hashed)
+        assert not [f for f in os.listdir(m31_lights) if f.startswith(".tmp-")]
+
+
+@pytest.mark.skipif(os.name != "posix", reason="uses hardlinks and fcntl")
+def test_clone_file_falls_back_without_leaking_temp_files():
+    """Test that a failed or unsupported reflink falls back cleanly."""
+    from siril_mcp.server import _clone_file, _file_digest
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = os.path.join(temp_dir, "frame.fit")
+        with open(source, "wb") as f:
+            f.write(b"frame")
+        lights = os.path.join(temp_dir, "lights")
+        os.makedirs(lights)
+
+        with patch("siril_mcp.server._CAN_REFLINK", False):
+            method = _clone_file(source, os.path.join(lights, "a.fit"))
+        assert method == ("hardlink", None)
+        with patch("fcntl.ioctl", side_effect=OSError("not supported")):
+            method = _clone_file(source, os.path.join(lights, "b.fit"))
+        assert method == ("hardlink", None)
+        # A copy is hashed on the way through
+        with (
+            patch("fcntl.ioctl", side_effect=OSError("not supported")),
+            patch("os.link", side_effect=OSError("cross-device link")),
+        ):
+            method = _clone_file(source, os.path.join(lights, "c.fit"))
+        assert method == ("copy", _file_digest(source))
+        assert sorted(os.listdir(lights)) == ["a.fit", "b.fit", "c.fit"]
+
+
+def test_ingest_into_single_project():
+    """Test ingesting into one project's lights/ without sorting by target."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from siril_mcp.server import INGEST_MAX_WORKERS, _ingest_seestar_frames
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        export = os.path.join(temp_dir, "export")
+        project = os.path.join(temp_dir, "project")
+        os.makedirs(os.path.join(project, "lights"))
+        os.makedirs(export)
+        with open(os.path.join(export, "frame.fit"), "wb") as f:
+            f.write(b"same")
+        # A different frame already has the incoming name
+        with open(os.path.join(project, "lights", "frame.fit"), "wb") as f:
+            f.write(b"diff")
+
+        with pytest.raises(ValueError, match="workers must be at least 1"):
+            _ingest_seestar_frames(export, project, sort_by_target=False, workers=0)
+        # Oversized requests are capped rather than spawning a thread each
+        with patch(
+            "siril_mcp.server.ThreadPoolExecutor", side_effect=ThreadPoolExecutor
+        ) as pool:
+            summary = _ingest_seestar_frames(
+                export, project, sort_by_target=False, workers=10_000
+            )
+        assert pool.call_args.kwargs["max_workers"] == INGEST_MAX_WORKERS
+
+        assert summary["ingested"] == 1
+        with open(os.path.join(project, "lights", "frame_1.fit"), "rb") as f:
+            assert f.read() == b"same"
 
 
 if __name__ == "__main__":